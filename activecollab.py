@@ -15,8 +15,17 @@ AC_HEADERS = {
     'Content-Type': 'application/json; charset=utf-8'
 }
 
+# One session for all the requests, so connections are reused
+session = requests.Session()
+
+# Requests made since the process started
+request_count = 0
+
 def get(api_path, params=None):
-    r = requests.get('{0}{1}'.format(
+    global request_count
+    request_count += 1
+
+    r = session.get('{0}{1}'.format(
         AC_BASE_URL, api_path), params=simplejson.dumps(params),
         headers=AC_HEADERS)
     try:
@@ -25,13 +34,13 @@ def get(api_path, params=None):
         return None
 
 def get_nojson(api_path, params=None):
-    r = requests.get('{0}{1}'.format(
+    r = session.get('{0}{1}'.format(
         AC_BASE_URL, api_path), params=simplejson.dumps(params),
         headers=AC_HEADERS)
     return r
 
 def post(api_path, params=None):
-    r = requests.post('{0}{1}'.format(
+    r = session.post('{0}{1}'.format(
         AC_BASE_URL, api_path), data=simplejson.dumps(params),
         headers=AC_HEADERS)
 
@@ -39,12 +48,12 @@ def post(api_path, params=None):
 
 
 def put(api_path, params=None):
-    r = requests.put('{0}{1}'.format(AC_BASE_URL, api_path),
+    r = session.put('{0}{1}'.format(AC_BASE_URL, api_path),
                      data=simplejson.dumps(params), headers=AC_HEADERS)
     return r.json()
 
 
 def upload(files):
-    r = requests.post('{0}upload-files'.format(
+    r = session.post('{0}upload-files'.format(
         AC_BASE_URL), files=files, headers=AC_HEADERS_UPLOAD)
     return r.json()
@@ -1,14 +1,28 @@
 #!/usr/bin/env python
 
+import argparse
+import json
 import logging
 import os
+import shutil
 import time
+from datetime import datetime
 
 import simplejson
 from pythonjsonlogger import jsonlogger
 from tqdm import tqdm
 
 import activecollab as ac
+from activecollab_manifest import (
+    MANIFEST_NAME,
+    get_entry,
+    load_manifest,
+    read_file,
+    start_manifest,
+    write_manifest,
+)
+from activecollab_pack import is_pack, list_snapshots
+from activecollab_retention import compact, prune
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -24,6 +38,32 @@ BACKUP_DIR = (
     "/data/prod/ac_data"
 )
 
+# How many daily backups to keep
+KEEP_DAILY = 7
+
+# How many weekly backups to keep
+KEEP_WEEKLY = 5
+
+# Day of week to save weekly snapshot, Monday is 0
+WEEKLY_DOW = 6
+
+# Day of month to save monthly snapshot
+MONTHLY_DOM = 1
+
+# Backups older than this many days are packed into a single file
+PACK_AFTER_DAYS = 2
+
+# Archived projects are crawled again after this many days, or when their
+# updated_on changes; in between their data is carried forward
+ARCHIVED_REFRESH_DAYS = 7
+
+# In daemon mode, minutes between incremental passes, which only crawl the
+# active projects whose updated_on changed
+DAEMON_INTERVAL_MINUTES = 10
+
+# In daemon mode, hour after which the day's full pass is run
+FULL_PASS_HOUR = 2
+
 
 # ############################################
 # Stop editing here!
@@ -36,19 +76,125 @@ FOLDER_NAME = time.strftime("%Y%m%d%H%M%S")
 # Current working directory
 CWD = os.path.join(BACKUP_DIR, DAILY_DIR, FOLDER_NAME)
 
+# When each project was last crawled, and its updated_on then
+STATE_FILE = os.path.join(BACKUP_DIR, "crawl_state.json")
+
+# Last run status in daemon mode
+STATUS_FILE = os.path.join(BACKUP_DIR, "status.json")
+
+# Entries of the manifest, one per saved file
+manifest = []
+
+# Root and manifest of the last backup made by this process
+last_snapshot = None
+
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", help="Keep running, with incremental passes and a nightly full pass", action="store_true")
+    arguments = parser.parse_args()
+
+    if arguments.daemon:
+        run_daemon()
+    else:
+        run_pass()
+        maintain()
+
+
+# Runs a backup into a new snapshot
+def run_pass(full=True):
+    global FOLDER_NAME, CWD
+
+    FOLDER_NAME = time.strftime("%Y%m%d%H%M%S")
+    CWD = os.path.join(BACKUP_DIR, DAILY_DIR, FOLDER_NAME)
+    manifest.clear()
+
     # Ensure folder structure
     create_dir(os.path.join(BACKUP_DIR, DAILY_DIR))
 
-    daily()
+    return daily(full)
+
+
+# Removes the backups not kept, then packs the older ones that are
+def maintain():
+    daily_dir = os.path.join(BACKUP_DIR, DAILY_DIR)
+    removed = prune(daily_dir, KEEP_DAILY, KEEP_WEEKLY, WEEKLY_DOW, MONTHLY_DOM)
+    packed, not_packed = compact(daily_dir, PACK_AFTER_DAYS)
+    logger.info(dict(removed=removed, packed=packed, not_packed=not_packed))
+
+    return dict(removed=removed, packed=packed, not_packed=not_packed)
+
 
+# Runs passes forever: a full pass once a day after FULL_PASS_HOUR, and an
+# incremental pass every DAEMON_INTERVAL_MINUTES otherwise
+def run_daemon():
+    status = load_json(STATUS_FILE, {})
 
-# Run a daily backup
-def daily():
+    while True:
+        started = time.time()
+        today = datetime.now().date().isoformat()
+        full = (
+            datetime.now().hour >= FULL_PASS_HOUR and status.get("last_full_day") != today
+        )
+        request_count = ac.request_count
+
+        status.update(running=True, full=full, started_on=started)
+        save_json(STATUS_FILE, status)
+
+        try:
+            crawled = run_pass(full)
+        except Exception as e:
+            logger.exception("Backup pass failed")
+            status.update(ok=False, error=repr(e))
+
+            # A backup that didn't finish would be kept over the last one that did
+            if not os.path.exists(os.path.join(CWD, MANIFEST_NAME)):
+                shutil.rmtree(CWD, ignore_errors=True)
+        else:
+            status.update(
+                ok=True, error=None, snapshot=FOLDER_NAME, last_success_on=started, **crawled
+            )
+            if full:
+                status.update(last_full_day=today, last_full_on=started)
+
+        # Packing and pruning fail on their own, the backup made is still good
+        try:
+            maintenance = maintain()
+        except Exception as e:
+            logger.exception("Backup maintenance failed")
+            status.update(maintenance=dict(ok=False, error=repr(e)))
+        else:
+            status.update(maintenance=dict(ok=not maintenance["not_packed"], **maintenance))
+
+        finished = time.time()
+        oldest_crawled_on = status.get("oldest_crawled_on")
+        status.update(
+            running=False,
+            finished_on=finished,
+            duration=finished - started,
+            requests=ac.request_count - request_count,
+            # How old the oldest data in the newest backup is, carried
+            # forward projects included
+            lag=finished - oldest_crawled_on if oldest_crawled_on else None,
+        )
+        save_json(STATUS_FILE, status)
+
+        time.sleep(max(0, started + DAEMON_INTERVAL_MINUTES * 60 - time.time()))
+
+
+# Run a daily backup, a full one crawls every active project, an incremental
+# one only those whose updated_on changed
+def daily(full=True):
+    global last_snapshot
+
+    previous = get_previous_snapshot()
+    state = load_json(STATE_FILE, {})
+    carried = 0
+    crawled = 0
 
     # Create our cwd
     create_dir(CWD)
+    start_manifest(CWD)
     create_dir(os.path.join(CWD, "projects"))
     create_dir(os.path.join(CWD, "projects/archived"))
 
@@ -105,6 +251,11 @@ def daily():
     for project in tqdm(projects):
         pid = project["id"]
 
+        unchanged = state.get(str(pid), {}).get("updated_on") == project.get("updated_on")
+        if not full and unchanged and carry_forward(previous, pid, False):
+            carried += 1
+            continue
+
         # Create our project tree
         project_dir = os.path.join(CWD, "projects", str(pid))
         tasks_dir = os.path.join(project_dir, "tasks")
@@ -208,6 +359,9 @@ def daily():
                     discussion, os.path.join(discussions_dir, "{0}.json".format(did))
                 )
 
+        state[str(pid)] = dict(updated_on=project.get("updated_on"), crawled_on=time.time())
+        crawled += 1
+
     # Get Archived Projects
     archived_projects = []
     project_page = []
@@ -224,6 +378,10 @@ def daily():
     for project in tqdm(archived_projects):
         pid = project["id"]
 
+        if is_fresh(project, state.get(str(pid), {})) and carry_forward(previous, pid, True):
+            carried += 1
+            continue
+
         # Create our project tree
         project_dir = os.path.join(CWD, "projects/archived", str(pid))
         tasks_dir = os.path.join(project_dir, "tasks")
@@ -295,6 +453,104 @@ def daily():
                     discussion, os.path.join(discussions_dir, "{0}.json".format(did))
                 )
 
+        state[str(pid)] = dict(updated_on=project.get("updated_on"), crawled_on=time.time())
+        crawled += 1
+
+    logger.info(dict(crawled=crawled, carried_forward=carried))
+    save_json(STATE_FILE, state)
+
+    write_manifest(CWD, manifest)
+    last_snapshot = (CWD, {entry["path"]: entry for entry in manifest})
+
+    # When the data carried forward the longest was crawled
+    oldest_crawled_on = min(
+        (
+            state.get(str(project["id"]), {}).get("crawled_on", time.time())
+            for project in projects + archived_projects
+        ),
+        default=time.time(),
+    )
+
+    return dict(crawled=crawled, carried_forward=carried, oldest_crawled_on=oldest_crawled_on)
+
+
+def load_json(path, default):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+# Replaces a JSON file in one go, so it's never read half written
+def save_json(path, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+
+    os.replace(f"{path}.tmp", path)
+
+
+# Whether an archived project's data from the last backup is recent enough
+def is_fresh(project, project_state):
+    if project_state.get("updated_on") != project.get("updated_on"):
+        return False
+
+    age = time.time() - project_state.get("crawled_on", 0)
+
+    return age < ARCHIVED_REFRESH_DAYS * 24 * 60 * 60
+
+
+# The root and manifest of the last backup that finished, if there is one
+def get_previous_snapshot():
+    # The daemon keeps the manifest of its last backup, while it's still there
+    if last_snapshot and os.path.isdir(last_snapshot[0]):
+        return last_snapshot
+
+    snapshots = list_snapshots(os.path.join(BACKUP_DIR, DAILY_DIR))
+
+    for name in sorted(snapshots, reverse=True):
+        if name == FOLDER_NAME:
+            continue
+
+        if (previous_manifest := load_manifest(snapshots[name])) is not None:
+            return snapshots[name], previous_manifest
+
+    return None
+
+
+# Copies a project's files from the last backup into this one, hardlinked
+# when they're in a directory, returns False if there are none
+def carry_forward(previous, pid, archived):
+    if not previous:
+        return False
+
+    root, previous_manifest = previous
+    if archived:
+        prefix = os.path.join("projects", "archived", str(pid), "")
+    else:
+        prefix = os.path.join("projects", str(pid), "")
+    paths = [path for path in previous_manifest if path.startswith(prefix)]
+
+    for path in paths:
+        target = os.path.join(CWD, path)
+        create_dir(os.path.dirname(target))
+
+        if is_pack(root):
+            with open(target, "wb") as outfile:
+                outfile.write(read_file(root, path))
+        else:
+            try:
+                os.link(os.path.join(root, path), target)
+            except OSError:
+                shutil.copyfile(os.path.join(root, path), target)
+
+        entry = previous_manifest[path]
+        manifest.append(
+            {key: value for key, value in entry.items() if key not in ["offset", "length"]}
+        )
+
+    return bool(paths)
+
 
 # Creates a directory if it doesn't exist
 def create_dir(directory):
@@ -302,10 +558,15 @@ def create_dir(directory):
         os.makedirs(directory)
 
 
-# Saves a JSON file to the current working directory
+# Saves a JSON file to the current working directory, and adds it to the manifest
 def save_file(jsonfile, filename):
-    with open(os.path.join(CWD, filename), "w") as outfile:
-        simplejson.dump(jsonfile, outfile)
+    path = os.path.join(CWD, filename)
+    content = simplejson.dumps(jsonfile).encode("utf-8")
+
+    with open(path, "wb") as outfile:
+        outfile.write(content)
+
+    manifest.append(get_entry(os.path.relpath(path, CWD), content, jsonfile))
 
 
 if __name__ == "__main__":
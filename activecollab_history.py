@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from typing import Optional
+
+from tqdm import tqdm
+
+from activecollab_manifest import (
+    get_object_key,
+    get_project_path,
+    list_complete_snapshots,
+    read_file,
+    read_manifest,
+)
+from activecollab_pack import get_snapshot_time
+
+default_history_path = "activecollab_history.db"
+
+VERSION_COLUMNS = [
+    "kind",
+    "object_id",
+    "project_id",
+    "taken_on",
+    "snapshot",
+    "updated_on",
+    "path",
+    "sha256",
+]
+
+
+class HistoryIndex:
+    """
+    Versions of the projects, tasks and discussions across all the daily
+    backups: the snapshot each version was first seen in, with its path,
+    hash and updated_on, and the snapshot an object was last deleted in.
+
+    Only the manifests are read when indexing, and a query never opens a
+    snapshot, so finding how an object looked on a date is a single lookup.
+    """
+
+    def __init__(self, path: str = default_history_path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "name TEXT PRIMARY KEY, "
+                "taken_on INTEGER NOT NULL)"
+            )
+            # A version with no path is the object being deleted
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS versions ("
+                "kind TEXT NOT NULL, "
+                "object_id INTEGER NOT NULL, "
+                "project_id INTEGER NOT NULL, "
+                "taken_on INTEGER NOT NULL, "
+                "snapshot TEXT NOT NULL, "
+                "updated_on INTEGER, "
+                "path TEXT, "
+                "sha256 TEXT, "
+                "PRIMARY KEY (kind, object_id, taken_on))"
+            )
+            # The latest version of every object that still exists
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS current ("
+                "kind TEXT NOT NULL, "
+                "object_id INTEGER NOT NULL, "
+                "project_id INTEGER NOT NULL, "
+                "sha256 TEXT NOT NULL, "
+                "PRIMARY KEY (kind, object_id))"
+            )
+
+    def last_snapshot(self) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT name FROM snapshots ORDER BY taken_on DESC LIMIT 1"
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def add_snapshot(self, name: str, objects: dict) -> dict:
+        # Records the objects of the next snapshot, (kind, object id) to
+        # version, and returns how many were added, changed and deleted
+        taken_on = get_snapshot_time(name)
+        counts = dict(added=0, changed=0, deleted=0)
+
+        with self.lock, self.connection:
+            current = {
+                (kind, object_id): (project_id, sha256)
+                for kind, object_id, project_id, sha256 in self.connection.execute(
+                    "SELECT kind, object_id, project_id, sha256 FROM current"
+                )
+            }
+
+            versions = []
+            for key, version in objects.items():
+                if not (found := current.get(key)):
+                    counts["added"] += 1
+                elif found[1] != version["sha256"]:
+                    counts["changed"] += 1
+                else:
+                    continue
+
+                versions.append(
+                    (
+                        *key,
+                        version["project_id"],
+                        taken_on,
+                        name,
+                        version["updated_on"],
+                        version["path"],
+                        version["sha256"],
+                    )
+                )
+
+            for key in current.keys() - objects.keys():
+                counts["deleted"] += 1
+                versions.append((*key, current[key][0], taken_on, name, None, None, None))
+
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO versions (kind, object_id, project_id, "
+                "taken_on, snapshot, updated_on, path, sha256) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                versions,
+            )
+            self.connection.execute("DELETE FROM current")
+            self.connection.executemany(
+                "INSERT INTO current (kind, object_id, project_id, sha256) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (*key, version["project_id"], version["sha256"])
+                    for key, version in objects.items()
+                ),
+            )
+            self.connection.execute(
+                "INSERT INTO snapshots (name, taken_on) VALUES (?, ?)", (name, taken_on)
+            )
+
+        return counts
+
+    def as_of(self, kind: str, object_id: int, timestamp: int) -> Optional[dict]:
+        # The version of the object in the last snapshot taken at or before
+        # the timestamp, None if it didn't exist then
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {', '.join(VERSION_COLUMNS)} FROM versions "
+                "WHERE kind = ? AND object_id = ? AND taken_on <= ? "
+                "ORDER BY taken_on DESC LIMIT 1",
+                (kind, object_id, timestamp),
+            ).fetchone()
+
+        if not row or row[VERSION_COLUMNS.index("path")] is None:
+            return None
+
+        return dict(zip(VERSION_COLUMNS, row))
+
+    def history(self, kind: str, object_id: int) -> list:
+        # Every version of the object, oldest first, deletions included
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(VERSION_COLUMNS)} FROM versions "
+                "WHERE kind = ? AND object_id = ? ORDER BY taken_on",
+                (kind, object_id),
+            ).fetchall()
+
+        return [dict(zip(VERSION_COLUMNS, row)) for row in rows]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def get_version_key(path: str) -> Optional[tuple]:
+    # Kind, id and project id of the object a file is the main file of, None
+    # for the files that aren't tracked
+    if not (found := get_project_path(path)):
+        return None
+
+    pid, parts = found
+    if parts[-1] == "subtasks.json" or not (key := get_object_key(parts)):
+        return None
+
+    return key[0], key[1] or pid, pid
+
+
+def get_objects(manifest: dict) -> dict:
+    objects = {}
+
+    for path, entry in manifest.items():
+        if key := get_version_key(path):
+            objects[key[:2]] = dict(
+                project_id=key[2],
+                updated_on=entry.get("updated_on"),
+                path=path,
+                sha256=entry["sha256"],
+            )
+
+    return objects
+
+
+def index_snapshots(index: HistoryIndex, daily_dir: str) -> None:
+    # Adds the snapshots newer than the last one indexed, in order; those
+    # without a manifest are left for when their backup has finished
+    last = index.last_snapshot()
+
+    snapshots = {
+        name: root
+        for name, root in list_complete_snapshots(daily_dir).items()
+        if not last or name > last
+    }
+
+    for name, root in tqdm(snapshots.items(), desc="Snapshots"):
+        manifest = read_manifest(root)
+        counts = index.add_snapshot(name, get_objects(manifest))
+
+        print(f"{name}: " + ", ".join(f"{count} {change}" for change, count in counts.items()))
+
+
+def find_version(
+    index: HistoryIndex, daily_dir: str, kind: str, version: dict
+) -> Optional[tuple]:
+    # Root and path of a kept snapshot holding the version: the one it was
+    # first seen in, or if that one was pruned, a later one from before the
+    # next version
+    key = (kind, version["object_id"])
+    until = next(
+        (
+            later["taken_on"]
+            for later in index.history(*key)
+            if later["taken_on"] > version["taken_on"]
+        ),
+        None,
+    )
+
+    for name, root in list_complete_snapshots(daily_dir).items():
+        if name < version["snapshot"]:
+            continue
+        if until is not None and get_snapshot_time(name) >= until:
+            break
+
+        if name == version["snapshot"]:
+            return root, version["path"]
+
+        found = get_objects(read_manifest(root)).get(key)
+        if found and found["sha256"] == version["sha256"]:
+            return root, found["path"]
+
+    return None
+
+
+def get_timestamp(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+
+    for date_format in ["%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return int(datetime.strptime(value, date_format).timestamp())
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError(f"{value} is not a date or timestamp")
+
+
+def print_version(version: dict) -> None:
+    taken_on = datetime.fromtimestamp(version["taken_on"]).isoformat(" ")
+    if version["path"] is None:
+        print(f"{taken_on} {version['snapshot']} deleted")
+        return
+
+    updated_on = ""
+    if version["updated_on"]:
+        updated_on = datetime.fromtimestamp(version["updated_on"]).isoformat(" ")
+
+    print(
+        f"{taken_on} {version['snapshot']} {version['path']} "
+        f"{version['sha256'][:12]} updated on {updated_on or 'unknown'}"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="History of ActiveCollab objects across backups")
+    parser.add_argument("-i", "--index", help="SQLite history index", default=default_history_path)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="Add the snapshots not indexed yet")
+    index_parser.add_argument("daily", help="Directory of the daily snapshots, BACKUP_DIR/daily")
+
+    as_of_parser = commands.add_parser("as-of", help="Version of an object at a date")
+    as_of_parser.add_argument("kind", choices=["project", "task", "discussion"])
+    as_of_parser.add_argument("id", type=int)
+    as_of_parser.add_argument("timestamp", help="YYYY-MM-DD, YYYY-MM-DD HH:MM or a unix timestamp", type=get_timestamp)
+    as_of_parser.add_argument("-d", "--daily", help="Print the object from this daily directory")
+
+    history_parser = commands.add_parser("history", help="Every version of an object")
+    history_parser.add_argument("kind", choices=["project", "task", "discussion"])
+    history_parser.add_argument("id", type=int)
+
+    arguments = parser.parse_args()
+    index = HistoryIndex(arguments.index)
+
+    if arguments.command == "index":
+        index_snapshots(index, arguments.daily)
+    elif arguments.command == "as-of":
+        if not (version := index.as_of(arguments.kind, arguments.id, arguments.timestamp)):
+            print(f"No {arguments.kind} {arguments.id} at that time")
+            return 1
+
+        print_version(version)
+        if arguments.daily:
+            if not (found := find_version(index, arguments.daily, arguments.kind, version)):
+                print("No snapshot kept holds this version")
+                return 1
+
+            content = read_file(*found)
+            print(json.dumps(json.loads(content), indent=2))
+    elif arguments.command == "history":
+        for version in index.history(arguments.kind, arguments.id):
+            print_version(version)
+
+    index.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
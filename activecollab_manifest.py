@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from typing import Optional
+
+from tqdm import tqdm
+
+from activecollab_pack import Pack, get_index_path, is_pack, list_snapshots
+
+MANIFEST_NAME = "manifest.json"
+# Marks a backup that has started, until its manifest replaces it
+PENDING_NAME = "manifest.pending"
+
+# Files are hashed in blocks, so even the largest fit in memory
+BLOCK_SIZE = 1024 * 1024
+
+# Kinds of objects compared by diff
+DIFF_KINDS = ["project", "task", "discussion", "time_record"]
+
+
+def get_object_version(data) -> tuple:
+    # Id and updated_on of the ActiveCollab object saved in a file, single
+    # objects come wrapped with their related data
+    if isinstance(data, dict):
+        data = data.get("single", data)
+
+        if isinstance(data, dict):
+            return data.get("id"), data.get("updated_on")
+
+    return None, None
+
+
+def get_entry(path: str, content: bytes, data=None) -> dict:
+    object_id, updated_on = get_object_version(data)
+
+    return dict(
+        path=path,
+        size=len(content),
+        sha256=hashlib.sha256(content).hexdigest(),
+        id=object_id,
+        updated_on=updated_on,
+    )
+
+
+def start_manifest(root: str) -> None:
+    # Written first, so a tree without a manifest but with this mark is a
+    # backup that didn't finish, rather than one from before manifests
+    open(os.path.join(root, PENDING_NAME), "w").close()
+
+
+def write_manifest(root: str, entries: list) -> None:
+    # Written last, so a tree without a manifest is a backup that didn't finish
+    manifest = dict(files=sorted(entries, key=lambda entry: entry["path"]))
+
+    with open(os.path.join(root, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+
+    if os.path.exists(os.path.join(root, PENDING_NAME)):
+        os.remove(os.path.join(root, PENDING_NAME))
+
+
+def get_manifest_path(root: str) -> str:
+    # The index of a pack is its manifest
+    return get_index_path(root) if is_pack(root) else os.path.join(root, MANIFEST_NAME)
+
+
+def load_manifest(root: str) -> Optional[dict]:
+    # Path to entry of every file in the manifest of a snapshot
+    try:
+        with open(get_manifest_path(root), "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return {entry["path"]: entry for entry in manifest["files"]}
+
+
+def read_manifest(root: str) -> dict:
+    # The manifest of a snapshot, built from its files for the backups made
+    # before there were manifests
+    if (manifest := load_manifest(root)) is not None:
+        return manifest
+
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"No snapshot at {root}")
+
+    manifest = {}
+    for path in list_files(root):
+        content = read_file(root, path)
+
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+
+        manifest[path] = get_entry(path, content, data)
+
+    return manifest
+
+
+def list_complete_snapshots(daily_dir: str) -> dict:
+    # The snapshots of list_snapshots whose backup finished: those with a
+    # manifest, and those made before there were manifests. One still marked
+    # as started is being written, or its backup crashed.
+    return {
+        name: root
+        for name, root in list_snapshots(daily_dir).items()
+        if os.path.exists(get_manifest_path(root))
+        or not os.path.exists(os.path.join(root, PENDING_NAME))
+    }
+
+
+def read_file(root: str, path: str) -> bytes:
+    # A file of a snapshot, whether it's a directory or a pack
+    if is_pack(root):
+        return open_pack(root).read(path)
+
+    with open(os.path.join(root, path), "rb") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=8)
+def open_pack(path: str) -> Pack:
+    # Packs are kept open, so their index is only loaded once
+    return Pack(path)
+
+
+def hash_file(path: str) -> Optional[tuple]:
+    # Size and sha256 of a file, None if it doesn't exist
+    digest = hashlib.sha256()
+    size = 0
+
+    try:
+        with open(path, "rb") as f:
+            while block := f.read(BLOCK_SIZE):
+                digest.update(block)
+                size += len(block)
+    except FileNotFoundError:
+        return None
+
+    return size, digest.hexdigest()
+
+
+def hash_packed(path: str, offset: int, length: int) -> Optional[tuple]:
+    # Size and sha256 of a file in a pack, None if it can't be decompressed
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        return None
+
+    return len(data), hashlib.sha256(data).hexdigest()
+
+
+def list_files(root: str) -> list:
+    # Paths of every file in a snapshot, relative to it
+    if is_pack(root):
+        return open_pack(root).list()
+
+    files = []
+
+    for directory, _, names in os.walk(root):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(directory, name), root))
+
+    return [path for path in files if path not in [MANIFEST_NAME, PENDING_NAME]]
+
+
+def verify(root: str, workers: Optional[int] = None) -> dict:
+    # Problems found in the snapshot, by kind, with the paths that have them
+    manifest = load_manifest(root)
+    if manifest is None:
+        return dict(manifest=[MANIFEST_NAME])
+
+    problems = dict(missing=[], size=[], hash=[], unexpected=[])
+    paths = sorted(manifest)
+
+    if is_pack(root):
+        problems["corrupt"] = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(paths) // ((workers or os.cpu_count() or 1) * 16))
+
+        if is_pack(root):
+            hashes = executor.map(
+                hash_packed,
+                repeat(root),
+                [manifest[path]["offset"] for path in paths],
+                [manifest[path]["length"] for path in paths],
+                chunksize=chunksize,
+            )
+        else:
+            hashes = executor.map(
+                hash_file,
+                [os.path.join(root, path) for path in paths],
+                chunksize=chunksize,
+            )
+
+        for path, found in tqdm(zip(paths, hashes), total=len(paths), desc="Files"):
+            entry = manifest[path]
+
+            if found is None and is_pack(root):
+                problems["corrupt"].append(path)
+            elif found is None:
+                problems["missing"].append(path)
+            elif found[0] != entry["size"]:
+                problems["size"].append(path)
+            elif found[1] != entry["sha256"]:
+                problems["hash"].append(path)
+
+    problems["unexpected"] = sorted(set(list_files(root)) - set(manifest))
+
+    return {kind: paths for kind, paths in problems.items() if paths}
+
+
+def get_project_path(path: str) -> Optional[tuple]:
+    # Project id and path within the project directory of a file, None for
+    # the files outside the projects
+    parts = path.split(os.sep)
+
+    if len(parts) > 3 and parts[:2] == ["projects", "archived"]:
+        if parts[2].isdigit():
+            return int(parts[2]), parts[3:]
+    elif len(parts) > 2 and parts[0] == "projects" and parts[1].isdigit():
+        return int(parts[1]), parts[2:]
+
+    return None
+
+
+def get_object_key(parts: list) -> Optional[tuple]:
+    # Kind and id of the object a file of a project belongs to, the same for
+    # a task whether it's open or completed, in an active or archived project
+    if parts == ["project.json"]:
+        return "project", None
+
+    if parts[0] == "discussions" and len(parts) == 2:
+        object_id = parts[1].split(".")[0]
+        return ("discussion", int(object_id)) if object_id.isdigit() else None
+
+    if parts[0] == "tasks" and len(parts) > 1:
+        if parts[1] == "archived":
+            parts = parts[1:]
+
+        # A file per task in archived projects, a directory in active ones
+        object_id = parts[1].split(".")[0] if len(parts) == 2 else parts[1]
+        if len(parts) in [2, 3] and object_id.isdigit():
+            return "task", int(object_id)
+
+    return None
+
+
+def get_project_trees(manifest: dict) -> dict:
+    # Project id to the hash of all its files, and the hashes of the files of
+    # each of its objects, so unchanged projects are skipped as a whole
+    files = defaultdict(dict)
+
+    for path, entry in manifest.items():
+        if found := get_project_path(path):
+            files[found[0]]["/".join(found[1])] = entry["sha256"]
+
+    trees = {}
+    for pid, hashes in files.items():
+        objects = defaultdict(list)
+        for path, sha256 in sorted(hashes.items()):
+            if key := get_object_key(path.split("/")):
+                objects[key].append(sha256)
+
+        digest = hashlib.sha256()
+        for path, sha256 in sorted(hashes.items()):
+            digest.update(f"{path}\0{sha256}\n".encode("utf-8"))
+
+        trees[pid] = dict(hash=digest.hexdigest(), objects=objects, files=hashes)
+
+    return trees
+
+
+def load_time_records(root: str, manifest: dict, pid: int) -> dict:
+    # Time records of a project by id, from whichever layout it was saved in
+    for path in [
+        os.path.join("projects", str(pid), "time-records.json"),
+        os.path.join("projects", "archived", str(pid), "time-records.json"),
+    ]:
+        if path in manifest:
+            records = json.loads(read_file(root, path))
+
+            if isinstance(records, dict):
+                records = records.get("time_records", [])
+
+            return {record["id"]: record for record in records}
+
+    return {}
+
+
+def diff(old_root: str, new_root: str) -> dict:
+    # Kind to added, removed and modified (project id, object id) between two
+    # snapshots; only the time records of changed projects are read
+    old_manifest = read_manifest(old_root)
+    new_manifest = read_manifest(new_root)
+
+    old_trees = get_project_trees(old_manifest)
+    new_trees = get_project_trees(new_manifest)
+
+    changes = {kind: dict(added=[], removed=[], modified=[]) for kind in DIFF_KINDS}
+    changes["project"]["added"] = [
+        (pid, pid) for pid in sorted(new_trees.keys() - old_trees.keys())
+    ]
+    changes["project"]["removed"] = [
+        (pid, pid) for pid in sorted(old_trees.keys() - new_trees.keys())
+    ]
+
+    for pid in sorted(old_trees.keys() & new_trees.keys()):
+        old_tree, new_tree = old_trees[pid], new_trees[pid]
+        if old_tree["hash"] == new_tree["hash"]:
+            continue
+
+        for kind, object_id in sorted(
+            old_tree["objects"].keys() | new_tree["objects"].keys(),
+            key=lambda key: (key[0], key[1] or 0),
+        ):
+            old_hashes = old_tree["objects"].get((kind, object_id))
+            new_hashes = new_tree["objects"].get((kind, object_id))
+
+            if old_hashes == new_hashes:
+                continue
+
+            if old_hashes is None:
+                change = "added"
+            elif new_hashes is None:
+                change = "removed"
+            else:
+                change = "modified"
+
+            changes[kind][change].append((pid, object_id or pid))
+
+        if old_tree["files"].get("time-records.json") != new_tree["files"].get(
+            "time-records.json"
+        ):
+            old_records = load_time_records(old_root, old_manifest, pid)
+            new_records = load_time_records(new_root, new_manifest, pid)
+
+            for record_id in sorted(old_records.keys() | new_records.keys()):
+                if record_id not in old_records:
+                    changes["time_record"]["added"].append((pid, record_id))
+                elif record_id not in new_records:
+                    changes["time_record"]["removed"].append((pid, record_id))
+                elif old_records[record_id] != new_records[record_id]:
+                    changes["time_record"]["modified"].append((pid, record_id))
+
+    return changes
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Checks ActiveCollab backups")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    verify_parser = commands.add_parser(
+        "verify", help="Re-hash a snapshot and compare it against its manifest"
+    )
+    verify_parser.add_argument("snapshot", help="Snapshot directory or pack, daily/<timestamp>[.pack]")
+    verify_parser.add_argument("-w", "--workers", help="Processes hashing files", type=int, default=os.cpu_count())
+
+    diff_parser = commands.add_parser(
+        "diff", help="List the objects changed between two snapshots"
+    )
+    diff_parser.add_argument("old", help="Older snapshot directory")
+    diff_parser.add_argument("new", help="Newer snapshot directory")
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "verify":
+        problems = verify(arguments.snapshot, arguments.workers)
+
+        for kind, paths in problems.items():
+            for path in paths:
+                print(f"{kind}: {path}")
+
+        print("OK" if not problems else f"{sum(map(len, problems.values()))} problems")
+
+        return 1 if problems else 0
+
+    if arguments.command == "diff":
+        changes = diff(arguments.old, arguments.new)
+
+        for kind, kind_changes in changes.items():
+            for change, objects in kind_changes.items():
+                for pid, object_id in objects:
+                    print(f"{change} {kind} {object_id} (project {pid})")
+
+        for kind, kind_changes in changes.items():
+            print(
+                f"{kind}: " + ", ".join(
+                    f"{len(objects)} {change}" for change, objects in kind_changes.items()
+                )
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Iterable
+
+# Snapshots are named after the time the backup started
+SNAPSHOT_FORMAT = "%Y%m%d%H%M%S"
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+
+
+class Pack:
+    """
+    A snapshot compacted into a single file: every file of the snapshot
+    compressed on its own with zlib, one after the other.
+
+    The sidecar index is the snapshot's manifest with the offset and length
+    of each file in the pack, so any file can be read without reading the
+    rest, and the manifest tools work on packs as they do on directories.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+        with open(get_index_path(path), "r") as f:
+            self.entries = {entry["path"]: entry for entry in json.load(f)["files"]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def list(self) -> list:
+        return list(self.entries)
+
+    def read(self, path: str) -> bytes:
+        if not (entry := self.entries.get(path)):
+            raise FileNotFoundError(f"{path} not in {self.path}")
+
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "rb")
+
+            self.file.seek(entry["offset"])
+            data = self.file.read(entry["length"])
+
+        return zlib.decompress(data)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def is_pack(path: str) -> bool:
+    return path.endswith(PACK_SUFFIX)
+
+
+def get_index_path(pack_path: str) -> str:
+    return pack_path[: -len(PACK_SUFFIX)] + INDEX_SUFFIX
+
+
+def write_pack(path: str, files: Iterable[tuple], entries: dict) -> None:
+    # Writes the (path, compressed content) files and then the index, the
+    # index last so a pack without one is a pack that didn't finish
+    index = []
+
+    with open(f"{path}.tmp", "wb") as f:
+        for file_path, compressed in files:
+            index.append(dict(entries[file_path], offset=f.tell(), length=len(compressed)))
+            f.write(compressed)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(f"{path}.tmp", path)
+
+    index_path = get_index_path(path)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(dict(files=index), f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def get_snapshot_time(name: str) -> int:
+    return int(time.mktime(time.strptime(name, SNAPSHOT_FORMAT)))
+
+
+def list_snapshots(daily_dir: str) -> dict:
+    # Snapshot name to its directory, or its pack once compacted
+    snapshots = {}
+
+    for name in sorted(os.listdir(daily_dir)):
+        if is_pack(name) and os.path.exists(
+            get_index_path(os.path.join(daily_dir, name))
+        ):
+            name = name[: -len(PACK_SUFFIX)]
+            snapshots[name] = os.path.join(daily_dir, name + PACK_SUFFIX)
+        elif os.path.isdir(os.path.join(daily_dir, name)):
+            snapshots.setdefault(name, os.path.join(daily_dir, name))
+
+    return {
+        name: root
+        for name, root in sorted(snapshots.items())
+        if len(name) == len(time.strftime(SNAPSHOT_FORMAT)) and name.isdigit()
+    }
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterable, Optional
+
+from tqdm import tqdm
+
+from activecollab_manifest import list_complete_snapshots, read_file, read_manifest
+from activecollab_pack import (
+    PACK_SUFFIX,
+    get_index_path,
+    get_snapshot_time,
+    is_pack,
+    list_snapshots,
+    write_pack,
+)
+
+logger = logging.getLogger()
+
+default_keep_daily = 7
+default_keep_weekly = 5
+# Monday is 0
+default_weekly_dow = 6
+default_monthly_dom = 1
+default_pack_after_days = 2
+
+COMPRESSION_LEVEL = 6
+
+# Files compressed at a time, so a snapshot is never all in memory
+BATCH_SIZE = 256
+
+
+def compress_files(root: str, manifest: dict, workers: int) -> Iterable[tuple]:
+    # Path and compressed content of every file of the snapshot, checked
+    # against the manifest so a corrupted file is never packed
+    def compress(path: str) -> tuple:
+        content = read_file(root, path)
+        if hashlib.sha256(content).hexdigest() != manifest[path]["sha256"]:
+            raise ValueError(f"{path} doesn't match the manifest of {root}")
+
+        return path, zlib.compress(content, COMPRESSION_LEVEL)
+
+    paths = sorted(manifest)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in tqdm(range(0, len(paths), BATCH_SIZE), desc="Files", leave=False):
+            yield from executor.map(compress, paths[start : start + BATCH_SIZE])
+
+
+def pack_snapshot(root: str, workers: int = 4) -> str:
+    # Packs a snapshot directory into a pack next to it, and removes it
+    pack_path = root.rstrip(os.sep) + PACK_SUFFIX
+
+    if not os.path.exists(get_index_path(pack_path)):
+        manifest = read_manifest(root)
+
+        try:
+            write_pack(pack_path, compress_files(root, manifest, workers), manifest)
+        except Exception:
+            if os.path.exists(f"{pack_path}.tmp"):
+                os.remove(f"{pack_path}.tmp")
+            raise
+
+    shutil.rmtree(root)
+
+    return pack_path
+
+
+def compact(
+    daily_dir: str,
+    days: int = default_pack_after_days,
+    workers: int = 4,
+    now: Optional[float] = None,
+) -> tuple:
+    # Packs the finished snapshots older than the given days, returns the
+    # names of those packed and of those left as they were, as a corrupted
+    # file in one snapshot mustn't keep the others from being packed
+    cutoff = (now or time.time()) - days * 24 * 60 * 60
+    packed = []
+    failed = []
+
+    for name, root in list_complete_snapshots(daily_dir).items():
+        if not is_pack(root) and get_snapshot_time(name) < cutoff:
+            try:
+                pack_snapshot(root, workers)
+            except Exception as e:
+                logger.exception(
+                    dict(message="Snapshot not packed", snapshot=name, error=repr(e))
+                )
+                failed.append(name)
+            else:
+                packed.append(name)
+
+    return packed, failed
+
+
+def get_kept(
+    names: Iterable[str],
+    keep_daily: int = default_keep_daily,
+    keep_weekly: int = default_keep_weekly,
+    weekly_dow: int = default_weekly_dow,
+    monthly_dom: int = default_monthly_dom,
+) -> set:
+    # Grandfather-father-son: the last snapshot of each of the latest days,
+    # of the latest weeks on the weekly day, and of every monthly day
+    by_day = {}
+    for name in sorted(names):
+        by_day[datetime.fromtimestamp(get_snapshot_time(name)).date()] = name
+
+    days = sorted(by_day, reverse=True)
+    weekly = [day for day in days if day.weekday() == weekly_dow]
+
+    kept = {by_day[day] for day in days[:keep_daily]}
+    kept.update(by_day[day] for day in weekly[:keep_weekly])
+    kept.update(by_day[day] for day in days if day.day == monthly_dom)
+
+    return kept
+
+
+def prune(
+    daily_dir: str,
+    keep_daily: int = default_keep_daily,
+    keep_weekly: int = default_keep_weekly,
+    weekly_dow: int = default_weekly_dow,
+    monthly_dom: int = default_monthly_dom,
+    dry_run: bool = False,
+) -> list:
+    # Removes the snapshots the retention policy doesn't keep, returns their
+    # names. One that hasn't finished is never kept in place of a finished
+    # one; it's removed once a newer one has finished, as its backup crashed
+    # or was stopped, and left alone while it may still be running.
+    snapshots = list_snapshots(daily_dir)
+    complete = list_complete_snapshots(daily_dir)
+    kept = get_kept(complete, keep_daily, keep_weekly, weekly_dow, monthly_dom)
+    removed = [
+        name
+        for name in snapshots
+        if name not in kept and (name in complete or name < max(complete, default=""))
+    ]
+
+    if dry_run:
+        return removed
+
+    for name in removed:
+        root = snapshots[name]
+
+        if is_pack(root):
+            os.remove(get_index_path(root))
+            os.remove(root)
+        else:
+            shutil.rmtree(root)
+
+    return removed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Packs and prunes ActiveCollab backups")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = commands.add_parser("compact", help="Pack the older snapshots")
+    compact_parser.add_argument("daily", help="Directory of the daily snapshots, BACKUP_DIR/daily")
+    compact_parser.add_argument("-d", "--days", help="Pack the snapshots older than this", type=int, default=default_pack_after_days)
+    compact_parser.add_argument("-w", "--workers", help="Threads compressing files", type=int, default=4)
+
+    prune_parser = commands.add_parser("prune", help="Remove the snapshots not kept by the retention policy")
+    prune_parser.add_argument("daily", help="Directory of the daily snapshots, BACKUP_DIR/daily")
+    prune_parser.add_argument("--keep-daily", type=int, default=default_keep_daily)
+    prune_parser.add_argument("--keep-weekly", type=int, default=default_keep_weekly)
+    prune_parser.add_argument("--weekly-dow", help="Day of the weekly snapshots, Monday is 0", type=int, default=default_weekly_dow)
+    prune_parser.add_argument("--monthly-dom", help="Day of the monthly snapshots", type=int, default=default_monthly_dom)
+    prune_parser.add_argument("-n", "--dry-run", help="Only list what would be removed", action="store_true")
+
+    extract_parser = commands.add_parser("extract", help="Print a file of a packed snapshot")
+    extract_parser.add_argument("pack", help="Snapshot pack, daily/<timestamp>.pack")
+    extract_parser.add_argument("path", help="Path of the file in the snapshot")
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "compact":
+        packed, failed = compact(arguments.daily, arguments.days, arguments.workers)
+
+        for name in packed:
+            print(f"packed {name}")
+        for name in failed:
+            print(f"not packed {name}, run verify on it")
+
+        return 1 if failed else 0
+    elif arguments.command == "prune":
+        for name in prune(
+            arguments.daily,
+            arguments.keep_daily,
+            arguments.keep_weekly,
+            arguments.weekly_dow,
+            arguments.monthly_dom,
+            arguments.dry_run,
+        ):
+            print(f"removed {name}")
+    elif arguments.command == "extract":
+        sys.stdout.buffer.write(read_file(arguments.pack, arguments.path))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
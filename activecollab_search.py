@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import argparse
+import html
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from tqdm import tqdm
+
+from activecollab_manifest import (
+    get_object_key,
+    get_project_path,
+    hash_file,
+    list_files,
+    load_manifest,
+    read_file,
+)
+
+default_index_path = "activecollab_search.db"
+
+
+class SearchIndex:
+    """
+    Full text index of the tasks, comments, discussions and notes of an
+    ActiveCollab backup, with their project and date to narrow searches.
+
+    The hash of every file indexed is kept, so indexing the next backup only
+    reads the files that changed, using its manifest when it has one.
+    """
+
+    def __init__(self, path: str = default_index_path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Each file is committed on its own, without waiting for the disk
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, "
+                "sha256 TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id INTEGER PRIMARY KEY, "
+                "path TEXT NOT NULL, "
+                "kind TEXT NOT NULL, "
+                "project_id INTEGER NOT NULL, "
+                "object_id INTEGER, "
+                "created_on INTEGER, "
+                "name TEXT)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS documents_path ON documents (path)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS documents_project "
+                "ON documents (project_id, created_on)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS documents_created ON documents (created_on)"
+            )
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(name, body)"
+            )
+
+    def get_hashes(self) -> dict:
+        with self.lock:
+            rows = self.connection.execute("SELECT path, sha256 FROM files").fetchall()
+
+        return dict(rows)
+
+    def replace(self, path: str, sha256: Optional[str], documents: list) -> None:
+        # Swaps the documents of a file for its new ones, or removes them all
+        # when the file is gone (sha256 is None)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM search WHERE rowid IN "
+                "(SELECT id FROM documents WHERE path = ?)",
+                (path,),
+            )
+            self.connection.execute("DELETE FROM documents WHERE path = ?", (path,))
+
+            if sha256 is None:
+                self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                return
+
+            for document in documents:
+                cursor = self.connection.execute(
+                    "INSERT INTO documents "
+                    "(path, kind, project_id, object_id, created_on, name) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        path,
+                        document["kind"],
+                        document["project_id"],
+                        document["object_id"],
+                        document["created_on"],
+                        document["name"],
+                    ),
+                )
+                self.connection.execute(
+                    "INSERT INTO search (rowid, name, body) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, document["name"], document["body"]),
+                )
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (path, sha256) VALUES (?, ?)",
+                (path, sha256),
+            )
+
+    def search(
+        self,
+        query: str,
+        project_id: Optional[int] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        limit: int = 20,
+    ) -> list:
+        conditions = ["search MATCH ?"]
+        parameters = [query]
+
+        if project_id is not None:
+            conditions.append("documents.project_id = ?")
+            parameters.append(project_id)
+        if since is not None:
+            conditions.append("documents.created_on >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("documents.created_on < ?")
+            parameters.append(until)
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT documents.kind, documents.project_id, documents.object_id, "
+                "documents.created_on, documents.name, documents.path, "
+                "snippet(search, 1, '[', ']', '...', 12) "
+                "FROM search JOIN documents ON documents.id = search.rowid "
+                f"WHERE {' AND '.join(conditions)} "
+                "ORDER BY rank LIMIT ?",
+                parameters + [limit],
+            ).fetchall()
+
+        keys = ["kind", "project_id", "object_id", "created_on", "name", "path", "snippet"]
+
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def get_text(item: dict) -> str:
+    # Plain text of an ActiveCollab body, tags stripped if there's only HTML
+    if text := item.get("body_plain_text"):
+        return text
+
+    return html.unescape(re.sub(r"<[^>]+>", " ", item.get("body") or ""))
+
+
+def get_document(kind: str, pid: int, item: dict, name: Optional[str] = None) -> dict:
+    return dict(
+        kind=kind,
+        project_id=pid,
+        object_id=item.get("id"),
+        created_on=item.get("created_on"),
+        name=name or item.get("name") or "",
+        body=get_text(item),
+    )
+
+
+def get_file_kind(path: str) -> Optional[str]:
+    # Kind of the indexed file at a path of a snapshot, None if not indexed
+    if not (found := get_project_path(path)):
+        return None
+
+    parts = found[1]
+    if parts == ["notes.json"]:
+        return "notes"
+
+    if parts[-1] == "subtasks.json" or not (key := get_object_key(parts)):
+        return None
+
+    return key[0] if key[0] in ["task", "discussion"] else None
+
+
+def get_documents(path: str, kind: str, data) -> list:
+    pid = get_project_path(path)[0]
+
+    if kind == "notes":
+        return [get_document("note", pid, note) for note in data or []]
+
+    single = data.get("single", {})
+    documents = [get_document(kind, pid, single)]
+
+    name = single.get("name")
+    for comment in (data.get("comments") or []) + (data.get("messages") or []):
+        documents.append(get_document("comment", pid, comment, name))
+
+    return documents
+
+
+def index_snapshot(index: SearchIndex, root: str) -> dict:
+    # Brings the index up to date with a snapshot, returns how many files
+    # were indexed, skipped as unchanged and removed
+    hashes = index.get_hashes()
+
+    if (manifest := load_manifest(root)) is not None:
+        files = {path: entry["sha256"] for path, entry in manifest.items()}
+    else:
+        files = {}
+        for path in list_files(root):
+            if get_file_kind(path) and (found := hash_file(os.path.join(root, path))):
+                files[path] = found[1]
+
+    counts = dict(indexed=0, unchanged=0, removed=0)
+    files = {path: sha256 for path, sha256 in files.items() if get_file_kind(path)}
+
+    for path, sha256 in tqdm(sorted(files.items()), desc="Files"):
+        if hashes.get(path) == sha256:
+            counts["unchanged"] += 1
+            continue
+
+        try:
+            data = json.loads(read_file(root, path))
+        except ValueError:
+            continue
+
+        index.replace(path, sha256, get_documents(path, get_file_kind(path), data))
+        counts["indexed"] += 1
+
+    for path in hashes.keys() - files.keys():
+        index.replace(path, None, [])
+        counts["removed"] += 1
+
+    return counts
+
+
+def get_timestamp(date: Optional[str]) -> Optional[int]:
+    if not date:
+        return None
+
+    return int(datetime.strptime(date, "%Y-%m-%d").timestamp())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Searches ActiveCollab backups")
+    parser.add_argument("-i", "--index", help="SQLite search index", default=default_index_path)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="Index the files of a snapshot that changed")
+    index_parser.add_argument("snapshot", help="Snapshot directory, daily/<timestamp>")
+
+    query_parser = commands.add_parser("query", help="Search the index")
+    query_parser.add_argument("query", help="FTS5 query, e.g. 'budget AND review'")
+    query_parser.add_argument("-p", "--project", help="ActiveCollab project id", type=int)
+    query_parser.add_argument("-s", "--since", help="Created on or after, YYYY-MM-DD")
+    query_parser.add_argument("-u", "--until", help="Created before, YYYY-MM-DD")
+    query_parser.add_argument("-n", "--limit", help="Results to show", type=int, default=20)
+
+    arguments = parser.parse_args()
+    index = SearchIndex(arguments.index)
+
+    if arguments.command == "index":
+        counts = index_snapshot(index, arguments.snapshot)
+        print(", ".join(f"{count} {name}" for name, count in counts.items()))
+    elif arguments.command == "query":
+        started = time.monotonic()
+        try:
+            results = index.search(
+                arguments.query,
+                arguments.project,
+                get_timestamp(arguments.since),
+                get_timestamp(arguments.until),
+                arguments.limit,
+            )
+        except sqlite3.OperationalError as e:
+            index.close()
+            query_parser.error(f"{e}, put terms with punctuation in double quotes")
+
+        for result in results:
+            date = ""
+            if result["created_on"]:
+                date = datetime.fromtimestamp(result["created_on"]).strftime("%Y-%m-%d")
+
+            print(
+                f"{result['kind']} {result['object_id']} (project {result['project_id']}) "
+                f"{date} {result['name']}\n    {result['snippet']}"
+            )
+
+        print(f"{len(results)} results in {(time.monotonic() - started) * 1000:.0f}ms")
+
+    index.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
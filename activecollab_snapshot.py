@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+from typing import Any, Optional
+
+from activecollab_pack import Pack, is_pack
+
+default_snapshot_path = "data"
+
+
+class Snapshot:
+    """
+    Read only view of an ActiveCollab backup, as written by
+    activecollab_backup.py and activecollab_backup_attachments.py.
+
+    The projects are indexed on first use, and every file is parsed once and
+    kept, so all the ClickUp tools can ask for the same data repeatedly
+    without going back to disk. Task files are found the same way whether
+    the project is active, with a directory per task, or archived, with a
+    file per task. A snapshot compacted into a pack is read the same way.
+    """
+
+    def __init__(self, path: str = default_snapshot_path) -> None:
+        self.path = path
+        self.lock = threading.RLock()
+        self.files = {}
+        self.index = None
+        self.pack = Pack(path) if is_pack(path) else None
+
+    def load(self, *parts: str, default: Any = None) -> Any:
+        # Parsed JSON of a file in the snapshot, default if it doesn't exist
+        key = os.path.join(*map(str, parts))
+
+        with self.lock:
+            if key in self.files:
+                return self.files[key]
+
+        try:
+            if self.pack:
+                data = json.loads(self.pack.read(key))
+            else:
+                with open(os.path.join(self.path, key), "r") as f:
+                    data = json.load(f)
+        except FileNotFoundError:
+            return default
+
+        with self.lock:
+            return self.files.setdefault(key, data)
+
+    def release(self, pid: int) -> None:
+        # Drops the parsed files of a project that won't be read again
+        prefix = os.path.join(self.project_dir(pid), "")
+
+        with self.lock:
+            for key in [key for key in self.files if key.startswith(prefix)]:
+                del self.files[key]
+
+    def projects(self) -> list:
+        return self.load("projects.json", default=[])
+
+    def archived_projects(self) -> list:
+        return self.load("archived_projects.json", default=[])
+
+    def get_index(self) -> dict:
+        # Project id to (project, archived)
+        with self.lock:
+            if self.index is None:
+                self.index = {project["id"]: (project, False) for project in self.projects()}
+                self.index.update(
+                    (project["id"], (project, True))
+                    for project in self.archived_projects()
+                )
+
+            return self.index
+
+    def project(self, pid: int) -> Optional[dict]:
+        # The project as listed in projects.json or archived_projects.json
+        if found := self.get_index().get(int(pid)):
+            return found[0]
+
+        return None
+
+    def is_archived(self, pid: int) -> bool:
+        return self.get_index()[int(pid)][1]
+
+    def project_dir(self, pid: int) -> str:
+        if self.is_archived(pid):
+            return os.path.join("projects", "archived", str(pid))
+
+        return os.path.join("projects", str(pid))
+
+    def project_path(self, pid: int) -> str:
+        return os.path.join(self.path, self.project_dir(pid))
+
+    def project_data(self, pid: int) -> dict:
+        # The project.json of the project, with hourly rates and budget
+        return self.load(self.project_dir(pid), "project.json", default={})
+
+    def notes(self, pid: int) -> list:
+        return self.load(self.project_dir(pid), "notes.json", default=[])
+
+    def tasks(self, pid: int) -> dict:
+        return self.load(self.project_dir(pid), "tasks.json", default={})
+
+    def time_records(self, pid: int) -> list:
+        records = self.load(self.project_dir(pid), "time-records.json", default={})
+
+        return records.get("time_records", [])
+
+    def expenses(self, pid: int) -> list:
+        expenses = self.load(self.project_dir(pid), "expenses.json", default={})
+
+        return expenses.get("expenses", []) if expenses else []
+
+    def task_file(self, pid: int, tid: int, is_completed: bool = False) -> str:
+        tasks_dir = os.path.join(self.project_dir(pid), "tasks")
+        if is_completed:
+            tasks_dir = os.path.join(tasks_dir, "archived")
+
+        # Archived projects are backed up with a flat file per task
+        if self.is_archived(pid):
+            return os.path.join(tasks_dir, f"{tid}.json")
+
+        return os.path.join(tasks_dir, str(tid), "tasks.json")
+
+    def task(self, pid: int, tid: int, is_completed: bool = False) -> Optional[dict]:
+        # The task with its subtasks, comments and subscribers, None if it
+        # wasn't backed up or its file is unreadable
+        try:
+            return self.load(self.task_file(pid, tid, is_completed))
+        except ValueError:
+            return None
+
+    def job_types(self) -> dict:
+        return {item["id"]: item for item in self.load("job_types.json", default=[])}
+
+    def companies(self) -> list:
+        return self.load("companies.json", default=[])
+
+    def users(self) -> list:
+        return self.load("users.json", default=[])
+
+    def labels(self) -> list:
+        return self.load("labels.json", default=[])
+
+    def attachment_projects(self) -> list:
+        # Ids of the projects with a listing of their attachments
+        try:
+            names = os.listdir(os.path.join(self.path, "attachments"))
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+        return sorted(
+            int(name[: -len(".json")])
+            for name in names
+            if name.endswith(".json") and name[: -len(".json")].isdigit()
+        )
+
+    def attachments(self, pid: int) -> list:
+        return self.load("attachments", f"{pid}.json", default=[])
+
+    def attachment_path(self, pid: int, attachment: dict) -> str:
+        return os.path.join(
+            os.path.abspath(self.path),
+            "attachments",
+            str(pid),
+            f"{attachment['id']}__{attachment['name']}",
+        )
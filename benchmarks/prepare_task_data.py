@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of clickup_import.prepare_task_data on synthetic projects.
+
+Run it from anywhere with `python benchmarks/prepare_task_data.py`. Each row
+doubles the size of the project; the time per record should stay roughly
+flat if the preparation scales linearly.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# prepare_task_data and the import log write their files to the working dir
+os.chdir(tempfile.mkdtemp())
+
+import clickup_import  # noqa: E402
+
+job_types = {
+    1: dict(name="development"),
+    2: dict(name="pre-project"),
+    3: dict(name="project management"),
+    4: dict(name="support"),
+}
+hourly_rates = {"1": 60.0, "2": 0, "3": 75.5, "4": 0}
+
+
+def synthetic_project(
+    n_tasks: int, records_per_task: int, import_type: int, seed: int = 0
+) -> tuple:
+    rnd = random.Random(seed)
+
+    project = dict(id=1, name="BENCH: Synthetic project", is_billable=True)
+    clickup_import.project_mappings[project["id"]] = dict(import_type=import_type)
+
+    task_ids = list(range(1, n_tasks + 1))
+    open_tasks = n_tasks // 2
+    tasks = dict(
+        tasks=[dict(id=tid) for tid in task_ids[:open_tasks]],
+        completed_task_ids=task_ids[open_tasks:],
+    )
+
+    records = []
+    for record_id in range(n_tasks * records_per_task):
+        on_task = rnd.random() < 0.9
+        records.append(
+            dict(
+                id=record_id,
+                job_type_id=rnd.choice(list(job_types)),
+                record_date=1500000000 + rnd.randint(0, 5 * 365 * 24 * 60 * 60),
+                value=rnd.choice([0.25, 0.5, 1, 2, 7.5]),
+                summary=f"Record {record_id}",
+                billable_status=rnd.choice([0, 1]),
+                parent_type="Task" if on_task else "Project",
+                parent_id=rnd.choice(task_ids) if on_task else project["id"],
+                created_by_id=1,
+            )
+        )
+
+    return tasks, records, project
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-t", "--tasks", type=int, default=500, help="Tasks in the smallest project")
+    parser.add_argument("-r", "--records", type=int, default=10, help="Time records per task")
+    parser.add_argument("-s", "--steps", type=int, default=5, help="Number of times to double the project")
+    parser.add_argument("-i", "--importtype", type=int, default=2, help="Project import type (1, 2 or 3)")
+    arguments = parser.parse_args()
+
+    print(f"{'tasks':>8} {'records':>8} {'seconds':>9} {'us/record':>10}")
+
+    for step in range(arguments.steps):
+        n_tasks = arguments.tasks * 2**step
+        tasks, records, project = synthetic_project(
+            n_tasks, arguments.records, arguments.importtype
+        )
+
+        start = time.perf_counter()
+        clickup_import.prepare_task_data(
+            "BENCH", tasks, records, job_types, hourly_rates, project
+        )
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{n_tasks:>8} {len(records):>8} {elapsed:>9.3f} "
+            f"{elapsed / len(records) * 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
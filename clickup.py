@@ -1,6 +1,10 @@
+import io
 import json
 import logging
+import os
+import threading
 import time
+import uuid
 from functools import lru_cache
 
 import requests
@@ -9,10 +13,143 @@ default_api_version = "v2"
 
 logger = logging.getLogger()
 
+# ClickUp allows 100 requests per minute per token on most plans
+default_requests_per_minute = 100
+# Seconds of requests that can be sent at once after being idle, a full
+# minute's worth would let the first minute go over the limit
+default_burst_seconds = 3
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread making requests through a client, so
+    concurrent imports stay within the per-minute ClickUp rate limit.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = default_requests_per_minute,
+        burst_seconds: float = default_burst_seconds,
+    ) -> None:
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class MultipartFile:
+    """
+    Multipart form body that reads its file from disk as it's sent, instead of
+    building the whole body in memory, so large attachments can be uploaded
+    several at a time.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, fields: dict, name: str, filename: str, file_path: str) -> None:
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        head = "".join(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{key}"\r\n\r\n'
+            f"{value}\r\n"
+            for key, value in fields.items()
+        )
+        head += (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; '
+            f'filename="{quote_header_value(filename)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        )
+        tail = f"\r\n--{boundary}--\r\n"
+
+        self.file = open(file_path, "rb")
+        self.parts = [
+            io.BytesIO(head.encode("utf-8")),
+            self.file,
+            io.BytesIO(tail.encode("utf-8")),
+        ]
+        self.length = sum(
+            len(part.getvalue()) for part in self.parts if part is not self.file
+        ) + os.path.getsize(file_path)
+        self.part = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        while chunk := self.read(self.chunk_size):
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self.part < len(self.parts) and size != 0:
+            chunk = self.parts[self.part].read(size)
+            if not chunk:
+                self.part += 1
+                continue
+
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        return b"".join(chunks)
+
+    def seek(self, offset: int) -> None:
+        # Only rewinding is needed, to send the body again
+        for part in self.parts:
+            part.seek(0)
+        self.part = 0
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def quote_header_value(value: str) -> str:
+    return value.replace("\r", "%0D").replace("\n", "%0A").replace('"', "%22")
+
 
 class ClickUp:
-    def __init__(self, team_id: int, api_token_v1: str, api_token_v2: str) -> None:
+    def __init__(
+        self,
+        team_id: int,
+        api_token_v1: str,
+        api_token_v2: str,
+        requests_per_minute: int = default_requests_per_minute,
+    ) -> None:
         self.team_id = team_id
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        # Option indexes of drop down and labels fields, by field id
+        self.field_options = {}
+        # Requests sent, in total and by each thread
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+        self.thread_requests = threading.local()
 
         # We can't access dicts until they've been created!
         self.api_urls = {}
@@ -30,10 +167,42 @@ class ClickUp:
     ) -> dict:
         url = f"{self.get_api_url(version)}/{endpoint}"
         headers = self.get_headers(version)
-        response = requests.get(url, headers=headers, params=params)
+        response = self._request("GET", url, headers=headers, params=params)
 
         return self._handle_response(response, url, params)
 
+    def _request(self, method: str, url: str, **kwargs):
+        self.rate_limiter.acquire()
+        self.count_request()
+        response = requests.request(method, url, **kwargs)
+
+        if response.status_code == 429:
+            # Another client is sharing the token, wait for the window to reset
+            reset = float(response.headers.get("X-RateLimit-Reset", time.time() + 60))
+            wait = max(reset - time.time(), 1)
+            logger.warning(dict(url=url, message=f"Rate limited, waiting {wait:.0f}s"))
+            time.sleep(wait)
+
+            for _, file in kwargs.get("files", {}).values():
+                file.seek(0)
+            if isinstance(kwargs.get("data"), MultipartFile):
+                kwargs["data"].seek(0)
+
+            self.rate_limiter.acquire()
+            self.count_request()
+            response = requests.request(method, url, **kwargs)
+
+        return response
+
+    def count_request(self) -> None:
+        with self.requests_lock:
+            self.requests += 1
+
+        self.thread_requests.count = self.get_thread_requests() + 1
+
+    def get_thread_requests(self) -> int:
+        return getattr(self.thread_requests, "count", 0)
+
     def _handle_response(
         self, response, url: str, data: dict, files: dict = {}
     ) -> dict:
@@ -77,8 +246,8 @@ class ClickUp:
         token: str = "",
     ) -> dict:
         url = f"{self.get_api_url(version)}/{endpoint}"
-        response = requests.post(
-            url, headers=self.get_headers(version, token), json=payload
+        response = self._request(
+            "POST", url, headers=self.get_headers(version, token), json=payload
         )
 
         try:
@@ -86,8 +255,8 @@ class ClickUp:
         except:
             # retry since if we're here, the response was not JSON as expected from the API.
             time.sleep(10)
-            response = requests.post(
-                url, headers=self.get_headers(version, token), json=payload
+            response = self._request(
+                "POST", url, headers=self.get_headers(version, token), json=payload
             )
             time.sleep(10)
         return self._handle_response(response, url, payload)
@@ -100,12 +269,24 @@ class ClickUp:
         version: str = default_api_version,
     ) -> dict:
         url = f"{self.get_api_url(version)}/{endpoint}"
-        response = requests.post(
-            url, headers=self.get_headers(version), data=payload, files=files
+        response = self._request(
+            "POST", url, headers=self.get_headers(version), data=payload, files=files
         )
 
         return self._handle_response(response, url, payload, files)
 
+    def post_stream(
+        self, endpoint: str, body: MultipartFile, version: str = default_api_version
+    ) -> dict:
+        url = f"{self.get_api_url(version)}/{endpoint}"
+        headers = self.get_headers(version)
+        headers["Content-Type"] = body.content_type
+        del headers["Content_Type"]
+
+        response = self._request("POST", url, headers=headers, data=body)
+
+        return self._handle_response(response, url, {}, {"file": body.file.name})
+
     def put(
         self,
         endpoint: str,
@@ -114,8 +295,8 @@ class ClickUp:
         token: str = "",
     ) -> dict:
         url = f"{self.get_api_url(version)}/{endpoint}"
-        response = requests.put(
-            url, headers=self.get_headers(version, token), json=payload
+        response = self._request(
+            "PUT", url, headers=self.get_headers(version, token), json=payload
         )
 
         return self._handle_response(response, url, payload)
@@ -125,14 +306,15 @@ class ClickUp:
         return self.get(f"team/{self.team_id}")["team"]
 
     @lru_cache
-    def get_member(self, email: str) -> dict:
-        found = list(
-            filter(lambda x: x["user"]["email"] == email, self.get_team()["members"])
-        )
-        if found:
-            return found[0]
+    def get_members_by_email(self) -> dict:
+        members = {}
+        for member in self.get_team()["members"]:
+            members.setdefault(member["user"]["email"], member)
 
-        return {}
+        return members
+
+    def get_member(self, email: str) -> dict:
+        return self.get_members_by_email().get(email, {})
 
     @lru_cache
     def get_or_create_space(self, name: str) -> dict:
@@ -288,14 +470,20 @@ class ClickUp:
         )
 
     @lru_cache
-    def get_or_create_task(
-        self, list_id: int, name: str, data: str, token: str = ""
-    ) -> dict:
+    def find_task(self, list_id: int, name: str) -> dict:
         if tasks := self.get_tasks(list_id):
             task = list(filter(lambda x: x["name"] == name, tasks))
             if task:
                 return task[0]
 
+        return {}
+
+    def get_or_create_task(
+        self, list_id: int, name: str, data: str, token: str = ""
+    ) -> dict:
+        if task := self.find_task(list_id, name):
+            return task
+
         payload = json.loads(data)
         payload["name"] = name
 
@@ -305,6 +493,10 @@ class ClickUp:
     def get_tasks(self, list_id: int) -> list:
         return self.get(f"list/{list_id}/task?include_closed=true")["tasks"]
 
+    # Not cached, used to poll lists ClickUp is still creating from a template
+    def get_list_tasks(self, list_id: int) -> list:
+        return self.get(f"list/{list_id}/task?include_closed=true").get("tasks", [])
+
     # No need to cache this!
     def upload_attachment_to_document(
         self, doc: dict, page: dict, name: str, file_path: str
@@ -323,11 +515,13 @@ class ClickUp:
 
     # No need to cache this!
     def upload_attachment_to_task(self, task: int, name: str, file_path: str):
-        with open(file_path, "rb") as file:
-            files = {"attachment": (name, file)}
-            payload = {"filename": name}
+        with MultipartFile({"filename": name}, "attachment", name, file_path) as body:
             logger.info(f"Uploading {name} to task {task}")
-            return self.post_multipart(f"task/{task}/attachment", payload, files)
+            return self.post_stream(f"task/{task}/attachment", body)
+
+    # Not cached, tasks are fetched to see their current state
+    def get_task(self, task: int) -> dict:
+        return self.get(f"task/{task}")
 
     # no need to cache
     def update_task(self, task: int, data: dict) -> dict:
@@ -351,8 +545,66 @@ class ClickUp:
     def get_custom_fields(self, list_id: int) -> list:
         return self.get(f"list/{list_id}/field")["fields"]
 
+    # Not cached, used to poll lists ClickUp is still creating from a template
+    def get_list_fields(self, list_id: int) -> list:
+        return self.get(f"list/{list_id}/field").get("fields", [])
+
+    # Fields of a folder or space are also returned with the fields of each
+    # of their lists
+    @lru_cache
+    def get_folder_fields(self, folder: int) -> list:
+        return self.get(f"folder/{folder}/field").get("fields", [])
+
+    @lru_cache
+    def get_space_fields(self, space: int) -> list:
+        return self.get(f"space/{space}/field").get("fields", [])
+
+    @lru_cache
+    def get_custom_fields_by_name(self, list_id: int) -> dict:
+        fields = {}
+        for field in self.get_custom_fields(list_id):
+            fields.setdefault(field["name"], field)
+
+        return fields
+
+    def get_field_options(self, field: dict, prefix: bool = False) -> dict:
+        # Normalised option names and labels of a drop down or labels field
+        # to the ids of the options matching them, with prefix every leading
+        # part of a name or label is a key as well
+        key = (field["id"], prefix)
+        if key not in self.field_options:
+            options = {}
+            for option in field.get("type_config", {}).get("options", []):
+                for text in (option.get("name"), option.get("label")):
+                    if text is None:
+                        continue
+
+                    text = normalise_option(text)
+                    for end in range(0 if prefix else len(text), len(text) + 1):
+                        ids = options.setdefault(text[:end], [])
+                        if option["id"] not in ids:
+                            ids.append(option["id"])
+
+            self.field_options[key] = options
+
+        return self.field_options[key]
+
     def set_custom_field(self, task: int, field: str, value) -> dict:
         return self.post(f"task/{task}/field/{field}", payload=dict(value=value))
 
     def create_time_entry(self, data: dict) -> dict:
-        return self.post(f"team/{self.team_id}/time_entries", payload=data)
\ No newline at end of file
+        return self.post(f"team/{self.team_id}/time_entries", payload=data)
+
+    def get_time_entries(
+        self, start_date: int, end_date: int, assignees: list = []
+    ) -> list:
+        # Without assignees ClickUp only returns the token owner's entries
+        params = dict(start_date=start_date, end_date=end_date)
+        if assignees:
+            params["assignee"] = ",".join(map(str, assignees))
+
+        return self.get(f"team/{self.team_id}/time_entries", params).get("data", [])
+
+
+def normalise_option(text: str) -> str:
+    return text.strip().lower()
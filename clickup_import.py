@@ -4,19 +4,24 @@ import locale
 import logging
 import os
 import re
-from datetime import datetime
-from glob import glob
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
 from time import sleep
-from typing import Optional
+from queue import Queue
+from typing import Callable, Optional
 import argparse
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from markdownify import markdownify
 from pythonjsonlogger import jsonlogger
 from tqdm import tqdm
-from pprint import pprint
 
-from clickup import ClickUp
+from activecollab_snapshot import Snapshot, default_snapshot_path
+from clickup import ClickUp, default_requests_per_minute, normalise_option
+from clickup_store import MappingStore, default_store_path
+import markdown_cache as markdown
 
 locale.setlocale(locale.LC_ALL, "en_GB.UTF-8")
 
@@ -31,16 +36,41 @@ import_attachments = True
 import_projects = True
 fix_expenses = False
 limit_projects_resume = []
+time_entry_workers = 4
+attachment_workers = 4
+# Writer threads of the import pipeline, 0 writes each task as it's read
+pipeline_writers = 0
+pipeline_size = 100
+# Skip the steps the import journal records as completed
+resume = False
+# Seconds to wait at most for ClickUp to finish a list created from a
+# template, and the first delay between checks, doubled after each one
+template_list_wait = 60
+template_list_poll = 0.5
+# Seconds to wait at most for the first list from a template, before what
+# its lists get is known, as a template may add nothing at all
+template_list_first_wait = 10
+# Seconds to wait for a list from a template known to add nothing
+template_list_settle = 2
+# Custom fields and tasks the lists created from each template get, by
+# template id
+template_contents = {}
 ac_user_initials = {}
 project_mappings = {}
 templates_by_name = {}
+# Markdown conversions of task bodies, set up from the command line
+markdown_cache: Optional[markdown.MarkdownCache] = None
 
+# Custom field holding the AC project id on the project details task
+ac_project_id_field = "1fabc62c-b9b9-42ef-b3f3-0158f2106ae2"
+# Custom field holding the hourly rate on tasks
+rate_field_id = "83c64fc3-773b-4006-bc0d-ab26c930efbd"
 
-def import_ac_labels(clickup: ClickUp, path: str = "data/labels.json") -> dict:
+
+def import_ac_labels(clickup: ClickUp, snapshot: Snapshot) -> dict:
     logger.info("Importing AC labels")
 
-    with open(path, "r") as f:
-        ac_labels = json.load(f)
+    ac_labels = snapshot.labels()
 
     spaces = {}
 
@@ -55,169 +85,44 @@ def import_ac_labels(clickup: ClickUp, path: str = "data/labels.json") -> dict:
 
 
 def import_expenses(
-    clickup: ClickUp, members: dict, path: str = "data"
+    clickup: ClickUp, members: dict, store: MappingStore, snapshot: Snapshot
 ) -> tuple:
     logger.info("Importing AC projects")
 
-    with open(os.path.join(path, "projects.json"), "r") as f:
-        ac_projects = json.load(f)
-    
-    with open(os.path.join(path, "archived_projects.json"), "r") as f:
-        archived_projects = json.load(f)
-
-    with open(os.path.join(path, "companies.json"), "r") as f:
-        companies = json.load(f)
-
-    with open(os.path.join(path, "job_types.json"), "r") as f:
-        job_types = json.load(f)
-        job_types = {item["id"]: item for item in job_types}
-
-    spaces = clickup.get_spaces()
-    folders = []
-    budget_tasks = {}
-
-    print('Searching spaces:')
-    for space in tqdm(spaces, desc="Spaces"):
-        space_folders = clickup.get_folders(space['id'])
-        archived_space_folders = clickup.get_folders(space['id'], True)
-        folders.extend(space_folders)
-        folders.extend(archived_space_folders)
-    
-    print('Found {0} folders'.format(len(folders)))
-
-    print('Generating AC folder data')
-
-    for folder in tqdm(folders, "Folders"):
-        acronym = re.split(r"[\[\(:;]", folder['name'])[0].strip()
-        md = clickup.get_or_create_list(folder['id'], '_Metadata')
-        md_tasks = clickup.get_tasks(md['id'])
-        info_task = [task for task in md_tasks if task['name'] == acronym]
-
-        if len(info_task):
-            # Bazinga!
-            task = info_task[0]
-            
-            cf = [field for field in task['custom_fields'] if field['id'] == '1fabc62c-b9b9-42ef-b3f3-0158f2106ae2']
-            if len(cf) and 'value' in cf[0]:
-                # Project was imported from AC and we have a valid AC ID!
-                ac_id = cf[0]['value']
-                try:
-                    budget_task = [task for task in md_tasks if task['name'] == 'Project budget'][0]
-                    budget_tasks[ac_id] = budget_task
-                except:
-                    print('Error: AC Project {0} has no Project budget task!'.format(ac_id))
-      
-    
-    ac_projects_to_fix = [proj for proj in ac_projects if str(proj['id']) in budget_tasks]
-    archived_projects_to_fix = [proj for proj in archived_projects if str(proj['id']) in budget_tasks]
-
-    for project in tqdm(ac_projects_to_fix, desc="Projects", position=0):
-        print("Fixing project: {0}".format(str(project["id"])))
-        project_path = os.path.join(path, "projects", str(project["id"]))
-        budget_task = budget_tasks[str(project['id'])]
+    if not store.count("project"):
+        discover_imported_projects(clickup, store)
 
-        expenses = []
-        if os.path.exists(os.path.join(project_path, "expenses.json")):
-            with open(os.path.join(project_path, "expenses.json")) as f:
-                expenses = json.load(f)["expenses"]
-
-        spend = 0
-        if expenses:
-            spend = sum(map(lambda x: x["value"], expenses))
-            expenses = map(
-                lambda x: (
-                    f"- _{get_date(x['record_date'])}_, "
-                    f"{x['summary']}: **{locale.currency(x['value'])}**"
-                ),
-                expenses,
-            )
-        else:
-            expenses = []
+    budget_tasks = {
+        ac_id: dict(id=task_id) for ac_id, task_id in store.all("budget_task").items()
+    }
 
-        custom_fields = [
-            # overall budget
-            dict(id="3dcddcd7-4a5b-4380-95c8-1154a9ce8ff8", value=project["budget"]),
-            # other expenses spend
-            dict(id="6e5a4048-e1ee-4ed8-b4b6-ffb54675fb5a", value=spend),
-        ]
-        
-        expenses_str = "\n".join(expenses)
-        data = dict(
-            markdown_description=f"## Expenses\n{expenses_str}",
-            assignees=[],
-            tags=["_meta", "budget"],
-            status="Open",
-            priority=None,
-            due_date_time=False,
-            time_estimate=None,
-            start_date_time=False,
-        )
-
-        print('Updating ID {0}'.format(budget_task['id']))
-
-        clickup.set_custom_field(budget_task['id'], "3dcddcd7-4a5b-4380-95c8-1154a9ce8ff8", project["budget"])
-        clickup.set_custom_field(budget_task['id'], "6e5a4048-e1ee-4ed8-b4b6-ffb54675fb5a", spend)
-        clickup.update_task(budget_task['id'], data)
+    projects_to_fix = [
+        project
+        for project in snapshot.projects() + snapshot.archived_projects()
+        if str(project["id"]) in budget_tasks
+    ]
 
-    for project in tqdm(archived_projects_to_fix, desc="Archived Projects", position=0):
+    for project in tqdm(projects_to_fix, desc="Projects", position=0):
         print("Fixing project: {0}".format(str(project["id"])))
-        project_path = os.path.join(path, "projects/archived", str(project["id"]))
         budget_task = budget_tasks[str(project['id'])]
 
-        expenses = []
-        if os.path.exists(os.path.join(project_path, "expenses.json")):
-            with open(os.path.join(project_path, "expenses.json")) as f:
-                expenses = json.load(f)["expenses"]
-
-        spend = 0
-        if expenses:
-            spend = sum(map(lambda x: x["value"], expenses))
-            expenses = map(
-                lambda x: (
-                    f"- _{get_date(x['record_date'])}_, "
-                    f"{x['summary']}: **{locale.currency(x['value'])}**"
-                ),
-                expenses,
-            )
-        else:
-            expenses = []
-            
-
-        custom_fields = [
-            # overall budget
-            dict(id="3dcddcd7-4a5b-4380-95c8-1154a9ce8ff8", value=project["budget"]),
-            # other expenses spend
-            dict(id="6e5a4048-e1ee-4ed8-b4b6-ffb54675fb5a", value=spend),
-        ]
-        
-        expenses_str = "\n".join(expenses)
-        data = dict(
-            markdown_description=f"## Expenses\n{expenses_str}",
-            assignees=[],
-            tags=["_meta", "budget"],
-            status="Open",
-            priority=None,
-            due_date_time=False,
-            time_estimate=None,
-            start_date_time=False,
-        )
+        data = prepare_budget_task(snapshot, project)
+        custom_fields = data.pop("custom_fields")
 
         print('Updating ID {0}'.format(budget_task['id']))
 
-        clickup.set_custom_field(budget_task['id'], "3dcddcd7-4a5b-4380-95c8-1154a9ce8ff8", project["budget"])
-        clickup.set_custom_field(budget_task['id'], "6e5a4048-e1ee-4ed8-b4b6-ffb54675fb5a", spend)
+        # Custom fields of an existing task can only be set one at a time
+        for field in custom_fields:
+            clickup.set_custom_field(budget_task["id"], field["id"], field["value"])
         clickup.update_task(budget_task['id'], data)
 
     return None
 
-def get_members(
-    clickup: ClickUp, path: str = "data/users.json", tokens: dict = {}
-) -> dict:
-    with open(path, "r") as f:
-        ac_users = json.load(f)
+def get_members(clickup: ClickUp, snapshot: Snapshot, tokens: dict = {}) -> dict:
+    ac_users = snapshot.users()
 
-        for user in ac_users:
-            ac_user_initials[user["id"]] = user["short_display_name"]
+    for user in ac_users:
+        ac_user_initials[user["id"]] = user["short_display_name"]
 
     members = dict(ac=ac_users)
 
@@ -231,14 +136,11 @@ def get_members(
     return members
 
 
-def import_ac_attachments(
-    clickup: ClickUp, path: str = "data"
-) -> None:
-    logger.info("Importing AC Attachments")
-
+def discover_imported_projects(clickup: ClickUp, store: MappingStore) -> None:
+    # Fallback for projects imported before the mapping store existed: find
+    # them by scanning every _Metadata list for the AC project ID field
     spaces = clickup.get_spaces()
     folders = []
-    folders_map = {}
 
     print('Searching spaces:')
     for space in tqdm(spaces, desc="Spaces"):
@@ -261,61 +163,137 @@ def import_ac_attachments(
             # Bazinga!
             task = info_task[0]
             
-            cf = [field for field in task['custom_fields'] if field['id'] == '1fabc62c-b9b9-42ef-b3f3-0158f2106ae2']
+            cf = [field for field in task['custom_fields'] if field['id'] == ac_project_id_field]
             if len(cf) and 'value' in cf[0]:
                 # Project was imported from AC and we have a valid AC ID!
                 ac_id = cf[0]['value']
-                folders_map[ac_id] = folder['id']
+                store.set("project", ac_id, folder['id'])
+                store.set("metadata_list", ac_id, md['id'])
+                store.set("details_task", ac_id, task['id'])
 
-    projects_json = glob((os.path.join(path, "attachments", "*.json")))
-    for project_json in tqdm(projects_json, desc="Projects"):
-        print("Processing {0}".format(project_json))
-        with open(project_json) as f:
-            attachments = json.load(f)
+                for md_task in md_tasks:
+                    if md_task['name'] == 'Project budget':
+                        store.set("budget_task", ac_id, md_task['id'])
+                    elif md_task['name'] == 'ActiveCollab attachments':
+                        store.set("attachments_task", ac_id, md_task['id'])
 
-            # Filter out google docs
-            attachments = [
-                a for a in attachments if "Google" not in a["class"]
-            ]
+                if not store.get("budget_task", ac_id):
+                    print('Error: AC Project {0} has no Project budget task!'.format(ac_id))
+
+
+def import_ac_attachments(
+    clickup: ClickUp, store: MappingStore, snapshot: Snapshot
+) -> None:
+    logger.info("Importing AC Attachments")
+
+    if not store.count("project"):
+        discover_imported_projects(clickup, store)
+
+    # Names of the files already on each attachments task to their ids
+    existing = {}
+    uploads = []
+    skipped = 0
+    # AC projects with attachments but no ClickUp folder in the store
+    missing = set()
+
+    for pid in tqdm(snapshot.attachment_projects(), desc="Projects"):
+        print("Processing attachments of {0}".format(pid))
+
+        # Filter out google docs
+        attachments = [
+            a for a in snapshot.attachments(pid) if "Google" not in a["class"]
+        ]
+
+        for attachment in attachments:
+
+            a_id = attachment["id"]
+            a_name = attachment["name"]
+            file_path = snapshot.attachment_path(pid, attachment)
+
+            if store.get("attachment", a_id):
+                skipped += 1
+                continue
+
+            ac_id = attachment["project_id"]
+            if not (task_id := store.get("attachments_task", ac_id)):
+                if not (list_id := store.get("metadata_list", ac_id)):
+                    if not (folder := store.get("project", ac_id)):
+                        if ac_id not in missing:
+                            missing.add(ac_id)
+                            logger.warning(
+                                f"-- AC project {ac_id} not in the mapping store, "
+                                "skipping its attachments, rerun with --discover"
+                            )
+                        continue
 
-            for attachment in tqdm(attachments, desc="Attachments"):
+                    list_id = clickup.get_or_create_list(int(folder), "_Metadata")["id"]
+                    store.set("metadata_list", ac_id, list_id)
 
-                a_id = attachment["id"]
-                a_name = attachment["name"]
-                file_path = os.path.join(
-                    os.path.splitext(os.path.abspath(project_json))[0],
-                    f"{a_id}__{a_name}",
+                data = {}
+                task = clickup.get_or_create_task(
+                    list_id, "ActiveCollab attachments", json.dumps(data)
                 )
+                task_id = task["id"]
+                store.set("attachments_task", ac_id, task_id)
+
+            # Files uploaded before the store recorded them are matched by
+            # name, each one only once
+            if task_id not in existing:
+                existing[task_id] = defaultdict(list)
+                for a in clickup.get_task(task_id).get("attachments", []):
+                    existing[task_id][a.get("title")].append(a["id"])
+
+            if attachment_ids := existing[task_id].get(a_name):
+                store.set("attachment", a_id, attachment_ids.pop())
+                skipped += 1
+                continue
+
+            uploads.append((task_id, a_id, a_name, file_path))
+
+    if skipped:
+        logger.info(f"-- Skipped {skipped} attachments already in ClickUp")
+
+    # Uploads share the client's rate limiter with every other request
+    with ThreadPoolExecutor(max_workers=attachment_workers) as executor:
+        futures = {
+            executor.submit(clickup.upload_attachment_to_task, task_id, a_name, file_path): (
+                a_id,
+                file_path,
+            )
+            for task_id, a_id, a_name, file_path in uploads
+        }
 
-                if str(attachment["project_id"]) in folders_map:
-                    folder = folders_map[str(attachment["project_id"])]
-                    task_list = clickup.get_or_create_list(int(folder), "_Metadata")
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Attachments"):
+            a_id, file_path = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                response = dict(err=repr(e))
 
-                    data = {}
-                    task = clickup.get_or_create_task(
-                        task_list["id"], "ActiveCollab attachments", json.dumps(data)
+            if attachment_id := response.get("id"):
+                store.set("attachment", a_id, attachment_id)
+            else:
+                logger.error(
+                    dict(
+                        message="Attachment not uploaded",
+                        attachment=a_id,
+                        file=file_path,
+                        response=response,
                     )
-                    clickup.upload_attachment_to_task(task["id"], a_name, file_path)
+                )
 
 
 def import_ac_projects(
-    clickup: ClickUp, spaces: dict, members: dict, path: str = "data"
+    clickup: ClickUp,
+    spaces: dict,
+    members: dict,
+    store: MappingStore,
+    snapshot: Snapshot,
+    workers: int = 1,
+    plan: Optional[dict] = None,
 ) -> tuple:
     logger.info("Importing AC projects")
 
-    with open(os.path.join(path, "projects.json"), "r") as f:
-        ac_projects = json.load(f)
-    
-    with open(os.path.join(path, "archived_projects.json"), "r") as f:
-        archived_projects = json.load(f)
-
-    with open(os.path.join(path, "companies.json"), "r") as f:
-        companies = json.load(f)
-
-    with open(os.path.join(path, "job_types.json"), "r") as f:
-        job_types = json.load(f)
-        job_types = {item["id"]: item for item in job_types}
-
     folders = {}
     lists = {}
     docs = {}
@@ -323,371 +301,970 @@ def import_ac_projects(
     tasks = {}
     comment_map = {}
 
-    # Sanity Check
-    for project in ac_projects:
-        if not project['id'] in project_mappings:
-            print("Project not in mappings: {}".format(project['id']))
-            exit()
-    for project in archived_projects:
-        if not project['id'] in project_mappings:
-            print("Project not in mappings: {}".format(project['id']))
-            exit()
-            
-    for project in tqdm(ac_projects, desc="Projects", position=0):
+    projects = get_ac_projects(snapshot)
 
-        if limit_projects and str(project["id"]) not in limit_projects:
-            continue
-        print("Importing project: {0}".format(str(project["id"])))
-        project_path = os.path.join(path, "projects", str(project["id"]))
+    # A compiled plan already has the prepared task data of each project
+    planned = {}
+    if plan:
+        planned = {p["id"]: p["task_data"] for p in plan["projects"]}
 
-        space = spaces[project["label_id"]]["id"]
+    def imported(project: dict, result: dict) -> None:
+        folders[project["id"]] = result["folder"]
+        lists[project["id"]] = result["list"]
+        docs[project["id"]] = result["doc"]
+        pages.update(result["pages"])
+        tasks.update(result["tasks"])
+        comment_map.update(result["comment_map"])
+
+        if limit_projects:
+            limit_projects_resume.remove(str(project["id"]))
+            print("To resume: -l {0}".format(",".join(limit_projects_resume)))
+
+    if workers > 1:
+        # Projects are independent of each other, so several can be imported
+        # at once; the client's rate limiter keeps them within the API limits
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    import_ac_project,
+                    clickup,
+                    spaces,
+                    members,
+                    store,
+                    snapshot,
+                    project,
+                    False,
+                    planned.get(project["id"]),
+                ): project
+                for project in projects
+            }
+
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="Projects", position=0
+            ):
+                project = futures[future]
+                try:
+                    imported(project, future.result())
+                except Exception as e:
+                    logger.exception(
+                        dict(
+                            message="Project import failed",
+                            project=project["id"],
+                            error=repr(e),
+                        )
+                    )
+                    failed.append(str(project["id"]))
+
+        if failed:
+            print("Failed projects, rerun with: --resume -l {0}".format(",".join(failed)))
+    else:
+        for project in tqdm(projects, desc="Projects", position=0):
+            imported(
+                project,
+                import_ac_project(
+                    clickup,
+                    spaces,
+                    members,
+                    store,
+                    snapshot,
+                    project,
+                    task_data=planned.get(project["id"]),
+                ),
+            )
+
+    if tasks:
+        print(
+            "ClickUp requests: {0}, {1:.2f} per task".format(
+                clickup.requests, clickup.requests / len(tasks)
+            )
+        )
+
+    return folders, lists, docs, pages, tasks, comment_map
 
-        folder = clickup.get_or_create_folder(space, project["name"])
-        folders[project["id"]] = folder
-        folder_name = folder["name"]
-        logger.info(f"- {folder_name}")
 
-        acronym = re.split(r"[\[\(:;]", folder_name)[0].strip()
+def import_ac_project(
+    clickup: ClickUp,
+    spaces: dict,
+    members: dict,
+    store: MappingStore,
+    snapshot: Snapshot,
+    project: dict,
+    progress: bool = True,
+    task_data: Optional[dict] = None,
+) -> dict:
+    pages = {}
+    tasks = {}
+    comment_map = {}
 
-        task_list = clickup.get_or_create_list(folder["id"], "_Metadata")
-        import_project_details(
-            project_path, clickup, task_list["id"], project, acronym, companies
+    # Steps already completed by a previous run, from the import journal
+    done = store.done_steps(project["id"]) if resume else set()
+
+    if "project" in done:
+        print("Skipping imported project: {0}".format(str(project["id"])))
+        return dict(
+            folder=dict(id=store.get("project", project["id"])),
+            list=dict(id=store.get("metadata_list", project["id"])),
+            doc=dict(id=store.get("doc", project["id"])),
+            pages=pages,
+            tasks=tasks,
+            comment_map=comment_map,
         )
-        lists[project["id"]] = task_list
 
+    print("Importing project: {0}".format(str(project["id"])))
+
+    space = spaces[project["label_id"]]["id"]
+
+    if "details" in done:
+        # The folder was created with the project name
+        folder = dict(id=store.get("project", project["id"]), name=project["name"])
+    elif folder_id := store.get("project", project["id"]):
+        folder = clickup.get_folder(folder_id)
+    else:
+        folder = clickup.get_or_create_folder(space, project["name"])
+        store.set("project", project["id"], folder["id"])
+    folder_name = folder["name"]
+    logger.info(f"- {folder_name}")
+
+    acronym = re.split(r"[\[\(:;]", folder_name)[0].strip()
+
+    if "details" in done:
+        metadata_list = dict(id=store.get("metadata_list", project["id"]))
+    else:
+        metadata_list = clickup.get_or_create_list(folder["id"], "_Metadata")
+        task_details, task_budget = import_project_details(
+            snapshot, clickup, metadata_list["id"], project, acronym
+        )
+        store.set("metadata_list", project["id"], metadata_list["id"])
+        if task_details:
+            store.set("details_task", project["id"], task_details.get("id"))
+        store.set("budget_task", project["id"], task_budget.get("id"))
+        store.mark_done(project["id"], "details")
+
+    if "notes" in done:
+        doc = dict(id=store.get("doc", project["id"]))
+    else:
         logger.info("-- Import notes")
-        doc = clickup.get_or_create_doc(task_list["id"], "Documents")
+        doc = clickup.get_or_create_doc(metadata_list["id"], "Documents")
         page = import_ac_note(clickup, doc["id"], "About", project["body"])
-        docs[project["id"]] = doc
+        store.set("doc", project["id"], doc["id"])
 
         # Import notes/documents!
         # Important fields are: name, body_plain_text, created_by_id, created_by_name
-        with open(os.path.join(project_path, "notes.json")) as f:
-            project_notes = json.load(f)
+        for note in tqdm(
+            snapshot.notes(project["id"]), desc="Notes", position=1, leave=False, disable=not progress
+        ):
+            if f"note:{note['id']}" in done:
+                continue
 
-        for note in tqdm(project_notes, desc="Notes", position=1, leave=False):
             body = f"Originally created by {note['created_by_name']}"
             body = f"{body} on {get_date(note['created_on'])}"
             body = f"{body}\n\n---\n\n{note['body_plain_text']}"
 
             page = import_ac_note(clickup, doc["id"], note["name"], body)
             pages[note["id"]] = page
+            store.set("page", note["id"], page.get("id"))
+            store.mark_done(project["id"], f"note:{note['id']}")
 
-        with open(os.path.join(project_path, "project.json")) as f:
-            hourly_rates = json.load(f)["hourly_rates"]
-
-        with open(os.path.join(project_path, "time-records.json")) as f:
-            time_records = json.load(f)["time_records"]
+        store.mark_done(project["id"], "notes")
 
-        with open(os.path.join(project_path, "tasks.json")) as f:
-            project_tasks = json.load(f)
+    hourly_rates = snapshot.project_data(project["id"])["hourly_rates"]
 
-        # import tasks
-        logger.info("-- Import tasks")
+    if task_data is None:
         task_data = prepare_task_data(
-            acronym, project_tasks, time_records, job_types, hourly_rates, project
+            acronym,
+            snapshot.tasks(project["id"]),
+            snapshot.time_records(project["id"]),
+            snapshot.job_types(),
+            hourly_rates,
+            project,
         )
 
-        for list_name in tqdm(task_data.keys(), desc="Lists", position=1, leave=False):
-            #template = "t-212487909"
-            # TODO: logic for this AND repeat below!
+    # import tasks
+    logger.info("-- Import tasks")
+
+    # ClickUp requests made to write each task, its subtasks and comments
+    task_requests = []
+
+    def write_task(
+        task_list_id: str,
+        list_name: str,
+        list_key: str,
+        ac_task_id: Optional[int],
+        prepared: Optional[dict],
+        completed: bool,
+        time_entry_data: list,
+    ) -> None:
+        # Writer stage: everything here is a ClickUp call, the payloads were
+        # prepared by the reader
+        requests = clickup.get_thread_requests()
+
+        if ac_task_id and completed:
+            task = dict(id=store.get("list_task", f"{list_key}:{ac_task_id}"))
+        elif ac_task_id:
+            task, task_comment_map = (
+                write_ac_task(clickup, task_list_id, prepared, store)
+                if prepared
+                else (None, None)
+            )
+            tasks[ac_task_id] = task
+            if task:
+                store.set("task", ac_task_id, task["id"])
+                store.set("list_task", f"{list_key}:{ac_task_id}", task["id"])
+                store.mark_done(project["id"], f"task:{list_name}:{ac_task_id}")
+
+            if task_comment_map is not None:
+                comment_map.update(task_comment_map)
+        elif completed:
+            task = dict(id=store.get("time_entries_task", list_key))
+        else:
+            task, _ = write_ac_task(clickup, task_list_id, prepared, store)
+            store.set("time_entries_task", list_key, task["id"])
+            store.mark_done(project["id"], f"time_entries_task:{list_name}")
 
-            if project_mappings[project["id"]]["import_type"] == 1:
-                template_name = project_mappings[project["id"]]["clickup_template"]
-            elif "pre-project" in list_name:
-                template_name = project_mappings[project["id"]]["unbillable_list"]
-            else:
-                template_name = project_mappings[project["id"]]["billable_list"]
+        if prepared:
+            task_requests.append(clickup.get_thread_requests() - requests)
 
-            template = templates_by_name[template_name]
+        if not task and time_entry_data:
+            logger.warning(
+                f"--- AC task {ac_task_id} not imported, skipping its time entries"
+            )
+            return
+
+        for ac_id, data in time_entry_data:
+            time_entries.submit(ac_id, {**data, "tid": task["id"]})
+
+    # Task bodies are converted in the process pool ahead of the network
+    # stage, the reader then finds every one of them in the markdown cache
+    if markdown_cache:
+        ac_tasks = [
+            snapshot.task(project["id"], pt["id"], pt["is_completed"])
+            for list_name, list_data in task_data.items()
+            for pt in list_data["tasks"]
+            if pt["id"] and f"task:{list_name}:{pt['id']}" not in done
+        ]
 
-            folder_lists = clickup.get_lists(folder["id"])
-            if found := list(filter(lambda x: x["name"] == list_name, folder_lists)):
+        markdown_cache.convert_all(
+            ac_task["single"]["body"]
+            for ac_task in ac_tasks
+            if ac_task and is_task_importable(ac_task)
+        )
+
+    # Time entries are sent in the background while the next tasks are
+    # imported, and all of them are created before the project is done
+    with TimeEntryWriter(
+        clickup, store, time_entry_workers, progress
+    ) as time_entries, ImportPipeline(
+        pipeline_writers, pipeline_size, progress
+    ) as pipeline:
+        # One request finds the project's entries ClickUp already has, in
+        # case the store lost track of them
+        time_entries.load_existing(
+            [
+                prepare_time_entry(members, record)
+                for list_data in task_data.values()
+                for pt in list_data["tasks"]
+                for record in pt["time_records"]
+                if not store.get("time_entry", record["id"])
+            ]
+        )
+
+        for list_name in tqdm(
+            task_data.keys(), desc="Lists", position=1, leave=False, disable=not progress
+        ):
+            template = templates_by_name[get_template_name(project, list_name)]
+
+            list_key = f"{project['id']}:{list_name}"
+            if list_id := store.get("list", list_key):
+                task_list = dict(id=list_id)
+            elif found := list(
+                filter(lambda x: x["name"] == list_name, clickup.get_lists(folder["id"]))
+            ):
                 task_list = found[0]
             else:
-                      
                 task_list = clickup.create_list_from_template(
                     folder["id"], list_name, template
                 )
+                if not "id" in task_list:
+                    print("error with task list, retrying")
+                    sleep(10)
+                    task_list = clickup.create_list_from_template(folder["id"], list_name, template)
+                if not "id" in task_list:
+                    raise RuntimeError(f"Could not create list {list_name}: {task_list}")
+
                 task_list = clickup.get_list(task_list["id"])
-                sleep(10)
+                wait_for_template_list(
+                    clickup, task_list["id"], template, folder["id"], space
+                )
 
             task_list_id = task_list["id"]
+            store.set("list", list_key, task_list_id)
 
             for pt in tqdm(
-                task_data[list_name]["tasks"], desc="Tasks", position=2, leave=False
+                task_data[list_name]["tasks"],
+                desc="Tasks",
+                position=2,
+                leave=False,
+                disable=not progress,
             ):
+                # Reader and transform stages: load the AC task and turn it
+                # into ready to send payloads
                 ac_task_id = pt["id"]
                 logger.debug(f"--- Importing AC task {ac_task_id}")
 
+                prepared = None
                 if ac_task_id:
-                    if pt["is_completed"]:
-                        task_path = os.path.join(
-                            project_path, "tasks/archived", str(ac_task_id)
+                    # Tasks with time records in several lists are imported in each
+                    completed = f"task:{list_name}:{ac_task_id}" in done
+                    if not completed:
+                        ac_task = snapshot.task(
+                            project["id"], ac_task_id, pt["is_completed"]
                         )
-                    else:
-                        task_path = os.path.join(project_path, "tasks", str(ac_task_id))
-                    try:
-                        with open(os.path.join(task_path, "tasks.json"), "r") as f:
-                            ac_task = json.load(f)
-
-                        task, task_comment_map = import_ac_task(
-                            clickup,
-                            task_list_id,
-                            ac_task,
-                            members,
-                            hourly_rates,
-                            pt["rate"],
+                        if not ac_task:
+                            # If we got here, task info was missing. Log for correction:
+                            with open("data.missing", 'a+') as f:
+                                f.write("{0}:{1}\n".format(project["id"], ac_task_id))
+                            continue
+
+                        prepared = prepare_ac_task(
+                            ac_task, members, hourly_rates, pt["rate"]
                         )
-                        tasks[ac_task["single"]["id"]] = task
-
-                        if task_comment_map is not None:
-                            comment_map = comment_map | task_comment_map
-                    except:
-                        # If we got here, task info was missing. Log for correction:
-                        with open("data.missing", 'a+') as f:
-                            f.write("{0}:{1}".format(project["id"], ac_task_id))
-                        continue
                 else:
-                    ac_task = dict(
-                        single=dict(
-                            assignee_id=0,
-                            body="",
-                            created_by_id=-1,
-                            due_on=0,
-                            estimate=0,
-                            is_completed=project["is_completed"],
-                            is_important=False,
-                            job_type_id=-1,
-                            name="ActiveCollab project time entries",
-                            start_on=0,
-                        ),
-                        comments=[],
-                        subscribers=[],
-                        subtasks=[],
-                        task_list=dict(name="inbox"),
-                        tracked_time=1,
-                    )
-                    task, _ = import_ac_task(
-                        clickup,
-                        task_list_id,
-                        ac_task,
-                        members,
-                        hourly_rates,
-                        pt["rate"],
-                    )
+                    completed = f"time_entries_task:{list_name}" in done
+                    if not completed:
+                        ac_task = dict(
+                            single=dict(
+                                assignee_id=0,
+                                body="",
+                                created_by_id=-1,
+                                due_on=0,
+                                estimate=0,
+                                is_completed=project["is_completed"],
+                                is_important=False,
+                                job_type_id=-1,
+                                name="ActiveCollab project time entries",
+                                start_on=0,
+                            ),
+                            comments=[],
+                            subscribers=[],
+                            subtasks=[],
+                            task_list=dict(name="inbox"),
+                            tracked_time=1,
+                        )
+                        prepared = prepare_ac_task(
+                            ac_task, members, hourly_rates, pt["rate"]
+                        )
+
+                time_entry_data = [
+                    (record["id"], prepare_time_entry(members, record))
+                    for record in pt["time_records"]
+                ]
+
+                pipeline.submit(
+                    write_task,
+                    task_list_id,
+                    list_name,
+                    list_key,
+                    ac_task_id,
+                    prepared,
+                    completed,
+                    time_entry_data,
+                )
+
+    # Time records of tasks that weren't imported have no entry either, the
+    # project is only done once a rerun has created all of them
+    missing = [
+        record["id"]
+        for list_data in task_data.values()
+        for pt in list_data["tasks"]
+        for record in pt["time_records"]
+        if not store.get("time_entry", record["id"])
+    ]
+    if missing:
+        logger.warning(
+            dict(
+                message="Time entries missing, project not marked as done",
+                project=project["id"],
+                time_records=len(missing),
+            )
+        )
+    else:
+        store.mark_done(project["id"], "project")
+    snapshot.release(project["id"])
 
-                for record in tqdm(
-                    pt["time_records"], desc="Time", position=3, leave=False
+    if task_requests:
+        logger.info(
+            dict(
+                message="Tasks written",
+                project=project["id"],
+                tasks=len(task_requests),
+                requests=sum(task_requests),
+                requests_per_task=round(sum(task_requests) / len(task_requests), 2),
+            )
+        )
+
+    return dict(
+        folder=folder,
+        list=metadata_list,
+        doc=doc,
+        pages=pages,
+        tasks=tasks,
+        comment_map=comment_map,
+    )
+
+
+def get_template_contents(
+    clickup: ClickUp, list_id: str, inherited: set
+) -> tuple:
+    # Custom fields of the list itself, not those of its folder or space,
+    # and tasks ClickUp has added to a list from a template so far; neither
+    # call is cached, so the cached lookups only run once the list is ready
+    fields = [
+        field
+        for field in clickup.get_list_fields(list_id)
+        if field["id"] not in inherited
+    ]
+
+    return len(fields), len(clickup.get_list_tasks(list_id))
+
+
+def wait_for_template_list(
+    clickup: ClickUp, list_id: str, template: str, folder: str, space: str
+) -> bool:
+    # ClickUp adds the template's custom fields and tasks to a new list in the
+    # background, tasks can't be created with them until they're all there.
+    # Until a list from the template has been seen ready, the list is ready
+    # once something was added and it stayed the same between two checks.
+    expected = template_contents.get(template)
+    if expected == (0, 0):
+        sleep(template_list_settle)
+        return True
+
+    inherited = {
+        field["id"]
+        for field in clickup.get_folder_fields(folder) + clickup.get_space_fields(space)
+    }
+    timeout = template_list_wait if expected else template_list_first_wait
+
+    started = time.monotonic()
+    delay = template_list_poll
+    previous = None
+
+    while True:
+        found = get_template_contents(clickup, list_id, inherited)
+
+        if expected:
+            if found[0] >= expected[0] and found[1] >= expected[1]:
+                break
+        elif found != (0, 0) and found == previous:
+            break
+
+        waited = time.monotonic() - started
+        if waited >= timeout:
+            # A template that adds nothing only has to be waited for once
+            if not expected and found == (0, 0):
+                template_contents[template] = found
+
+            logger.warning(
+                dict(
+                    message="List from template not ready, carrying on",
+                    list=list_id,
+                    waited=round(waited, 1),
+                    fields=found[0],
+                    tasks=found[1],
+                )
+            )
+            return False
+
+        previous = found
+        sleep(min(delay, timeout - waited))
+        delay *= 2
+
+    template_contents.setdefault(template, found)
+    logger.debug(
+        f"--- List {list_id} ready after {time.monotonic() - started:.1f}s"
+    )
+
+    return True
+
+
+def prepare_time_entry(members: dict, record: dict) -> dict:
+    # The task id is added once the task exists in ClickUp
+    return dict(
+        description=record["summary"],
+        start=record["ts"],
+        billable=record["billable_status"] == 1,
+        duration=record["value"],
+        assignee=get_assignee(members, record["created_by_id"])["user"]["id"],
+        tags=[
+            dict(name="activecollab"),
+            dict(name=ac_user_initials[record["created_by_id"]]),
+            dict(name=record["tag"]),
+        ],
+    )
+
+
+def get_ac_projects(snapshot: Snapshot) -> list:
+    # Every project to import, active ones first
+    ac_projects = snapshot.projects()
+    archived_projects = snapshot.archived_projects()
+
+    # Sanity Check
+    for project in ac_projects:
+        if not project['id'] in project_mappings:
+            print("Project not in mappings: {}".format(project['id']))
+            exit()
+    for project in archived_projects:
+        if not project['id'] in project_mappings:
+            print("Project not in mappings: {}".format(project['id']))
+            exit()
+
+    projects = ac_projects + archived_projects
+    if limit_projects:
+        projects = [p for p in projects if str(p["id"]) in limit_projects]
+
+    return projects
+
+
+def get_template_name(project: dict, list_name: str) -> str:
+    if project_mappings[project["id"]]["import_type"] == 1:
+        return project_mappings[project["id"]]["clickup_template"]
+
+    if "pre-project" in list_name:
+        return project_mappings[project["id"]]["unbillable_list"]
+
+    return project_mappings[project["id"]]["billable_list"]
+
+
+def compile_import_plan(
+    snapshot: Snapshot, requests_per_minute: int = default_requests_per_minute
+) -> dict:
+    # Works out everything an import would do from the AC snapshot alone, so
+    # it can be sized in advance and executed without preparing it again
+    job_types = snapshot.job_types()
+
+    attachments = {}
+    for pid in snapshot.attachment_projects():
+        for attachment in snapshot.attachments(pid):
+            if "Google" not in attachment["class"]:
+                project_id = attachment["project_id"]
+                attachments[project_id] = attachments.get(project_id, 0) + 1
+
+    projects = []
+    for project in tqdm(get_ac_projects(snapshot), desc="Projects"):
+        projects.append(
+            plan_ac_project(
+                snapshot, project, job_types, attachments.get(project["id"], 0)
+            )
+        )
+        snapshot.release(project["id"])
+
+    calls = {}
+    for project in projects:
+        for step, count in project["calls"].items():
+            calls[step] = calls.get(step, 0) + count
+
+    total_calls = sum(calls.values())
+    wait_seconds = sum(project["wait_seconds"] for project in projects)
+
+    return dict(
+        created_on=datetime.now().isoformat(timespec="seconds"),
+        path=snapshot.path,
+        requests_per_minute=requests_per_minute,
+        calls=calls,
+        total_calls=total_calls,
+        wait_seconds=wait_seconds,
+        estimated_seconds=round(total_calls * 60 / requests_per_minute + wait_seconds),
+        projects=projects,
+    )
+
+
+def plan_ac_project(
+    snapshot: Snapshot, project: dict, job_types: dict, attachments: int = 0
+) -> dict:
+    # API calls are counted for a first import, following import_ac_project
+    calls = dict(
+        # folder lookup and creation
+        folder=2,
+        # _Metadata list, details and budget tasks, the details fields are
+        # set when the details task is created
+        metadata=6,
+        # Documents view, pages lookup and the About page
+        notes=5,
+        lists=0,
+        tasks=0,
+        subtasks=0,
+        comments=0,
+        time_entries=0,
+        # attachments task lookup, its current files and one upload per file
+        attachments=4 + attachments if attachments else 0,
+    )
+
+    acronym = re.split(r"[\[\(:;]", project["name"])[0].strip()
+
+    notes = [note["name"] for note in snapshot.notes(project["id"])]
+    calls["notes"] += len(notes)
+
+    task_data = prepare_task_data(
+        acronym,
+        snapshot.tasks(project["id"]),
+        snapshot.time_records(project["id"]),
+        job_types,
+        snapshot.project_data(project["id"])["hourly_rates"],
+        project,
+    )
+
+    lists = []
+    missing = []
+    for list_name, list_data in task_data.items():
+        # lists lookup, creation from the template, fetching the new list and
+        # checking it's ready
+        calls["lists"] += 4
+        # existing tasks lookup
+        calls["tasks"] += 1
+
+        list_tasks = []
+        for pt in list_data["tasks"]:
+            if pt["id"]:
+                if not (
+                    ac_task := snapshot.task(project["id"], pt["id"], pt["is_completed"])
                 ):
-                    data = dict(
-                        description=record["summary"],
-                        start=record["ts"],
-                        billable=record["billable_status"] == 1,
-                        duration=record["value"],
-                        assignee=get_assignee(members, record["created_by_id"])["user"][
-                            "id"
-                        ],
-                        tid=task["id"],
-                        tags=[
-                            dict(name="activecollab"),
-                            dict(name=ac_user_initials[record["created_by_id"]]),
-                            dict(name=record["tag"]),
-                        ],
-                    )
-                    resp = clickup.create_time_entry(data)
+                    missing.append(pt["id"])
+                    continue
 
-        if limit_projects:
-            limit_projects_resume.remove(str(project["id"]))
-            print("To resume: -l {0}".format(",".join(limit_projects_resume)))
+                if not is_task_importable(ac_task):
+                    continue
 
-    for project in tqdm(archived_projects, desc="Projects", position=0):
-        if limit_projects and str(project["id"]) not in limit_projects:
-            continue
-        print("Importing project: {0}".format(str(project["id"])))
-        project_path = os.path.join(path, "projects/archived", str(project["id"]))
+                name = ac_task["single"]["name"]
+                subtasks = len(ac_task["subtasks"])
+                comments = len(ac_task["comments"])
+                followers = bool(ac_task["subscribers"])
+            else:
+                name = "ActiveCollab project time entries"
+                subtasks = 0
+                comments = 0
+                followers = False
+
+            # creation, and the followers update when there are any
+            calls["tasks"] += 2 if followers else 1
+            if name.lower() == "check project status":
+                calls["tasks"] += 1
+            calls["subtasks"] += subtasks
+            # existing comments lookup and one call per comment
+            calls["comments"] += 1 + comments if comments else 0
+            calls["time_entries"] += len(pt["time_records"])
+
+            list_tasks.append(
+                dict(
+                    id=pt["id"],
+                    name=name,
+                    subtasks=subtasks,
+                    comments=comments,
+                    time_entries=len(pt["time_records"]),
+                )
+            )
 
-        space = spaces[project["label_id"]]["id"]
+        lists.append(
+            dict(
+                name=list_name,
+                template=get_template_name(project, list_name),
+                tasks=list_tasks,
+            )
+        )
 
-        folder = clickup.get_or_create_folder(space, project["name"])
-        folders[project["id"]] = folder
-        folder_name = folder["name"]
-        logger.info(f"- {folder_name}")
+    # existing time entries lookup
+    if calls["time_entries"]:
+        calls["time_entries"] += 1
+
+    return dict(
+        id=project["id"],
+        name=project["name"],
+        archived=snapshot.is_archived(project["id"]),
+        path=snapshot.project_path(project["id"]),
+        notes=notes,
+        lists=lists,
+        attachments=attachments,
+        missing_tasks=missing,
+        calls=calls,
+        wait_seconds=len(lists) * template_list_poll,
+        task_data=task_data,
+    )
 
-        acronym = re.split(r"[\[\(:;]", folder_name)[0].strip()
 
-        task_list = clickup.get_or_create_list(folder["id"], "_Metadata")
-        import_project_details(
-            project_path, clickup, task_list["id"], project, acronym, companies
+def print_import_plan(plan: dict) -> None:
+    lists = [l for project in plan["projects"] for l in project["lists"]]
+    tasks = [t for l in lists for t in l["tasks"]]
+
+    print("Projects: {0}".format(len(plan["projects"])))
+    print("Lists: {0}".format(len(lists)))
+    print("Tasks: {0}".format(len(tasks)))
+    print("Subtasks: {0}".format(sum(t["subtasks"] for t in tasks)))
+    print("Comments: {0}".format(sum(t["comments"] for t in tasks)))
+    print("Time entries: {0}".format(sum(t["time_entries"] for t in tasks)))
+    print("Attachments: {0}".format(sum(p["attachments"] for p in plan["projects"])))
+    print("API calls:")
+    for step, count in plan["calls"].items():
+        print("  {0}: {1}".format(step, count))
+    print("  total: {0}".format(plan["total_calls"]))
+    print(
+        "Estimated time at {0} requests/minute: {1}".format(
+            plan["requests_per_minute"], timedelta(seconds=plan["estimated_seconds"])
         )
-        lists[project["id"]] = task_list
+    )
 
-        logger.info("-- Import notes")
-        doc = clickup.get_or_create_doc(task_list["id"], "Documents")
-        page = import_ac_note(clickup, doc["id"], "About", project["body"])
-        docs[project["id"]] = doc
 
-        # Import notes/documents!
-        # Important fields are: name, body_plain_text, created_by_id, created_by_name
-        with open(os.path.join(project_path, "notes.json")) as f:
-            project_notes = json.load(f)
+class ImportPipeline:
+    """
+    Bounded queue between the reader and transform stages of an import, that
+    load AC data and build the ClickUp payloads, and a pool of writer threads
+    that send them, so CPU work and network waits overlap. With no writers
+    each item is written as soon as it is submitted.
+
+    A full queue blocks the reader until a writer catches up; the time spent
+    blocked and the throughput of each stage are shown with the progress.
+    """
+
+    def __init__(self, writers: int = 0, size: int = 100, progress: bool = True) -> None:
+        self.writers = writers
+        self.queue = Queue(maxsize=size)
+        self.lock = threading.Lock()
+        self.read = 0
+        self.written = 0
+        self.blocked = 0.0
+        self.error = None
+        self.started = time.monotonic()
+        self.progress = tqdm(
+            desc="Written",
+            position=4,
+            leave=False,
+            disable=not progress or not writers,
+        )
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(writers)
+        ]
+        for thread in self.threads:
+            thread.start()
 
-        for note in tqdm(project_notes, desc="Notes", position=1, leave=False):
-            body = f"Originally created by {note['created_by_name']}"
-            body = f"{body} on {get_date(note['created_on'])}"
-            body = f"{body}\n\n---\n\n{note['body_plain_text']}"
+    def __enter__(self):
+        return self
 
-            page = import_ac_note(clickup, doc["id"], note["name"], body)
-            pages[note["id"]] = page
+    def __exit__(self, *args) -> None:
+        self.close()
 
-        with open(os.path.join(project_path, "project.json")) as f:
-            hourly_rates = json.load(f)["hourly_rates"]
+    def submit(self, write: Callable, *args) -> None:
+        self.read += 1
 
-        with open(os.path.join(project_path, "time-records.json")) as f:
-            time_records = json.load(f)["time_records"]
+        if not self.writers:
+            write(*args)
+            self.written += 1
+            return
 
-        with open(os.path.join(project_path, "tasks.json")) as f:
-            project_tasks = json.load(f)
+        # Stop reading as soon as a writer has failed
+        if self.error:
+            raise self.error
 
-        # import tasks
-        logger.info("-- Import tasks")
-        task_data = prepare_task_data(
-            acronym, project_tasks, time_records, job_types, hourly_rates, project
+        start = time.monotonic()
+        self.queue.put((write, args))
+        self.blocked += time.monotonic() - start
+
+    def work(self) -> None:
+        while (item := self.queue.get()) is not None:
+            write, args = item
+            try:
+                if self.error is None:
+                    write(*args)
+            except Exception as e:
+                with self.lock:
+                    self.error = self.error or e
+            finally:
+                with self.lock:
+                    self.written += 1
+                    self.progress.update()
+                    self.progress.set_postfix(self.stats(), refresh=False)
+                self.queue.task_done()
+
+        self.queue.task_done()
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+
+        return dict(
+            queued=self.queue.qsize(),
+            read=f"{self.read / elapsed:.1f}/s",
+            written=f"{self.written / elapsed:.1f}/s",
+            blocked=f"{self.blocked:.1f}s",
         )
 
-        for list_name in tqdm(task_data.keys(), desc="Lists", position=1, leave=False):
-            
-            if project_mappings[project["id"]]["import_type"] == 1:
-                template_name = project_mappings[project["id"]]["clickup_template"]
-            elif "pre-project" in list_name:
-                template_name = project_mappings[project["id"]]["unbillable_list"]
-            else:
-                template_name = project_mappings[project["id"]]["billable_list"]
+    def close(self) -> None:
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.progress.close()
+
+        if self.writers:
+            logger.info(dict(message="-- Import pipeline", **self.stats()))
+
+        if self.error:
+            raise self.error
+
+
+class TimeEntryWriter:
+    """
+    Creates time entries concurrently, in the background of the task import.
+
+    Every entry is retried on failure, and the ids of created entries are kept
+    in the mapping store so entries already in ClickUp are skipped on reruns.
+    Entries ClickUp has that the store doesn't know about are matched by their
+    fingerprint, once they've been loaded with load_existing.
+    """
+
+    def __init__(
+        self,
+        clickup: ClickUp,
+        store: MappingStore,
+        workers: int = 4,
+        progress: bool = True,
+        retries: int = 3,
+    ) -> None:
+        self.clickup = clickup
+        self.store = store
+        self.retries = retries
+        self.progress = progress
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.skipped = 0
+        # Entries still not created after all their retries
+        self.failed = 0
+        # Fingerprints of the entries already in ClickUp to their ids
+        self.existing = defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def load_existing(self, entries: list) -> None:
+        # Fetches the ClickUp entries in the date range and of the assignees of
+        # the entries about to be submitted, in a single request
+        if not entries:
+            return
+
+        start = min(entry["start"] for entry in entries)
+        end = max(entry["start"] + entry["duration"] for entry in entries)
+        assignees = sorted({entry["assignee"] for entry in entries})
+
+        for entry in self.clickup.get_time_entries(start, end + 1, assignees):
+            if task := entry.get("task"):
+                fingerprint = get_time_entry_fingerprint(
+                    task["id"],
+                    entry["start"],
+                    entry["duration"],
+                    entry["user"]["id"],
+                    entry.get("description", ""),
+                )
+                self.existing[fingerprint].append(entry["id"])
+
+    def submit(self, ac_id: int, data: dict) -> None:
+        fingerprint = get_time_entry_fingerprint(
+            data["tid"],
+            data["start"],
+            data["duration"],
+            data["assignee"],
+            data["description"],
+        )
 
-            template = templates_by_name[template_name]
+        with self.lock:
+            if self.store.get("time_entry", ac_id):
+                self.skipped += 1
+                return
 
-            folder_lists = clickup.get_lists(folder["id"])
-            if found := list(filter(lambda x: x["name"] == list_name, folder_lists)):
-                task_list = found[0]
-            else:
-                task_list = clickup.create_list_from_template(
-                    folder["id"], list_name, template
+            # Identical AC records each match a different ClickUp entry
+            if entry_ids := self.existing.get(fingerprint):
+                self.store.set("time_entry", ac_id, entry_ids.pop())
+                self.skipped += 1
+                return
+
+            self.futures.append(self.executor.submit(self.create, ac_id, data))
+
+    def create(self, ac_id: int, data: dict) -> Optional[str]:
+        for attempt in range(1, self.retries + 1):
+            try:
+                response = self.clickup.create_time_entry(data)
+            except Exception as e:
+                response = dict(err=repr(e))
+
+            if entry_id := response.get("data", {}).get("id"):
+                self.store.set("time_entry", ac_id, entry_id)
+                return entry_id
+
+            logger.warning(
+                dict(
+                    message="Time entry not created",
+                    time_record=ac_id,
+                    attempt=attempt,
+                    response=response,
                 )
-                if not "id" in task_list:
-                    print("error with task list, retrying")
-                    sleep(10)
-                    task_list = clickup.create_list_from_template(folder["id"], list_name, template)
-                    sleep(10)
-                try:
-                    task_list = clickup.get_list(task_list["id"])
-                except:
-                    pprint(task_list)
-                    exit()
-                sleep(10)
+            )
+            if attempt < self.retries:
+                sleep(2**attempt)
 
-            task_list_id = task_list["id"]
+        logger.error(
+            dict(message="Time entry failed", time_record=ac_id, payload=data)
+        )
 
-            for pt in tqdm(
-                task_data[list_name]["tasks"], desc="Tasks", position=2, leave=False
-            ):
-                ac_task_id = pt["id"]
-                logger.debug(f"--- Importing AC task {ac_task_id}")
+        with self.lock:
+            self.failed += 1
 
-                if ac_task_id:
-                    if pt["is_completed"]:
-                        task_path = os.path.join(
-                            project_path, "tasks/archived"
-                        )
-                    else:
-                        task_path = os.path.join(project_path, "tasks")
-                    try:
-                        with open(os.path.join(task_path, "{0}.json".format(str(ac_task_id))), "r") as f:
-                            ac_task = json.load(f)
-                    except:
-                        # If we got here, task info was missing. Log for correction:
-                        with open("data.missing", 'a+') as f:
-                            f.write("{0}:{1}".format(project["id"], ac_task_id))
-                        continue
+        return None
 
-                    task, task_comment_map = import_ac_task(
-                        clickup,
-                        task_list_id,
-                        ac_task,
-                        members,
-                        hourly_rates,
-                        pt["rate"],
-                    )
-                    tasks[ac_task["single"]["id"]] = task
+    def close(self) -> None:
+        for future in tqdm(
+            as_completed(self.futures),
+            total=len(self.futures),
+            desc="Time",
+            position=3,
+            leave=False,
+            disable=not self.progress,
+        ):
+            future.result()
 
-                    if task_comment_map is not None:
-                        comment_map = comment_map | task_comment_map
-                else:
-                    ac_task = dict(
-                        single=dict(
-                            assignee_id=0,
-                            body="",
-                            created_by_id=-1,
-                            due_on=0,
-                            estimate=0,
-                            is_completed=project["is_completed"],
-                            is_important=False,
-                            job_type_id=-1,
-                            name="ActiveCollab project time entries",
-                            start_on=0,
-                        ),
-                        comments=[],
-                        subscribers=[],
-                        subtasks=[],
-                        task_list=dict(name="inbox"),
-                        tracked_time=1,
-                    )
-                    task, _ = import_ac_task(
-                        clickup,
-                        task_list_id,
-                        ac_task,
-                        members,
-                        hourly_rates,
-                        pt["rate"],
-                    )
+        self.executor.shutdown()
 
-                for record in tqdm(
-                    pt["time_records"], desc="Time", position=3, leave=False
-                ):
-                    data = dict(
-                        description=record["summary"],
-                        start=record["ts"],
-                        billable=record["billable_status"] == 1,
-                        duration=record["value"],
-                        assignee=get_assignee(members, record["created_by_id"])["user"][
-                            "id"
-                        ],
-                        tid=task["id"],
-                        tags=[
-                            dict(name="activecollab"),
-                            dict(name=ac_user_initials[record["created_by_id"]]),
-                            dict(name=record["tag"]),
-                        ],
-                    )
-                    resp = clickup.create_time_entry(data)
+        if self.skipped:
+            logger.info(f"-- Skipped {self.skipped} time entries already in ClickUp")
 
-        if limit_projects:
-            limit_projects_resume.remove(str(project["id"]))
-            print("To resume: -l {0}".format(",".join(limit_projects_resume)))
+        if self.failed:
+            raise RuntimeError(f"{self.failed} time entries could not be created")
 
-    return folders, lists, docs, pages, tasks, comment_map
+
+def get_time_entry_fingerprint(
+    task_id, start, duration, assignee, description: str
+) -> tuple:
+    # ClickUp returns times as strings of whole milliseconds
+    return (
+        str(task_id),
+        int(float(start)),
+        round(float(duration)),
+        str(assignee),
+        (description or "").strip(),
+    )
 
 
 def import_project_details(
-    project_path: str,
+    snapshot: Snapshot,
     clickup: ClickUp,
     task_list_id: int,
     project: dict,
     acronym: str,
-    companies: list,
 ) -> tuple[dict, dict]:
     task_details = None
     task_budget = None
 
+    companies = snapshot.companies()
     if companies := list(filter(lambda x: x["id"] == project["company_id"], companies)):
         logger.info("-- Import project details")
         details = {"Partner organisation(s)": "King's College, London"}
@@ -717,11 +1294,29 @@ def import_project_details(
             # partner organisation
             dict(id="d98a262e-632d-4b9f-8776-520fbe5b29ee", value=[]),
             # ac project id
-            dict(id="1fabc62c-b9b9-42ef-b3f3-0158f2106ae2", value=str(project["id"])),
+            dict(id=ac_project_id_field, value=str(project["id"])),
             # spend
             dict(id="b05c5fb3-d3b6-4cd4-bf37-e3142666f051", value=0),
         ]
 
+        # The details are resolved to field options up front so a new task is
+        # created with them instead of setting each one afterwards
+        field_values = {}
+        fields = clickup.get_custom_fields_by_name(task_list_id)
+        for key, value in details.items():
+            if field := fields.get(key):
+                options = clickup.get_field_options(field)
+                if field_value := options.get(normalise_option(value)):
+                    if key == "Faculty":
+                        field_value = field_value[0]
+                    field_values[field["id"]] = field_value
+
+        custom_fields = [
+            custom_field
+            for custom_field in custom_fields
+            if custom_field["id"] not in field_values
+        ] + [dict(id=key, value=value) for key, value in field_values.items()]
+
         data = dict(
             description="",
             assignees=[],
@@ -734,37 +1329,33 @@ def import_project_details(
             custom_fields=custom_fields,
         )
 
+        existing = bool(clickup.find_task(task_list_id, acronym))
+
         task_details = clickup.get_or_create_task(
             task_list_id, acronym, json.dumps(data)
         )
 
-        fields = clickup.get_custom_fields(task_list_id)
-        if fields and len(fields) > 0:
-            for key, value in details.items():
-                if field := list(filter(lambda x: x["name"] == key, fields)):
-                    field = field[0]
+        # An existing task doesn't get the create payload
+        if existing:
+            for field_id, field_value in field_values.items():
+                try:
+                    clickup.set_custom_field(task_details["id"], field_id, field_value)
+                except:
+                    pass
 
-                if field_options := list(
-                    filter(
-                        lambda x: x.get("name") == value or x.get("label") == value,
-                        field["type_config"]["options"],
-                    )
-                ):
-                    field_value = list(map(lambda x: x["id"], field_options))
-                    if key == "Faculty":
-                        field_value = field_value[0]
-                    try:
-                        clickup.set_custom_field(
-                            task_details["id"], field["id"], field_value
-                        )
-                    except:
-                        pass
+
+    data = prepare_budget_task(snapshot, project)
+
+    task_budget = clickup.get_or_create_task(
+        task_list_id, "Project budget", json.dumps(data)
+    )
+
+    return task_details, task_budget
 
 
-    expenses = []
-    if os.path.exists(os.path.join(project_path, "expenses.json")):
-        with open(os.path.join(project_path, "expenses.json")) as f:
-            expenses = json.load(f)["expenses"]
+def prepare_budget_task(snapshot: Snapshot, project: dict) -> dict:
+    # Complete payload of the project budget task, custom fields included
+    expenses = snapshot.expenses(project["id"])
 
     spend = 0
     if expenses:
@@ -799,11 +1390,7 @@ def import_project_details(
         custom_fields=custom_fields,
     )
 
-    task_budget = clickup.get_or_create_task(
-        task_list_id, "Project budget", json.dumps(data)
-    )
-
-    return task_details, task_budget
+    return data
 
 
 def get_date(timestamp: int) -> str:
@@ -825,6 +1412,21 @@ def prepare_task_data(
     with open("prepared_time_records.json", "w") as f:
         json.dump(prepared_time_records, f)
 
+    # Index the time records once, so grouping them is linear in the number
+    # of records rather than tasks x records
+    records_by_task = defaultdict(list)
+    records_without_task = defaultdict(list)
+    for tr in prepared_time_records:
+        records_by_task[tr["task_id"]].append(tr)
+        if tr["task_id"] == None:
+            records_without_task[tr["list_name"]].append(tr)
+
+    # Tasks without time records go in the list of the latest time record
+    if len(prepared_time_records):
+        default_list_name = prepared_time_records[-1]["list_name"]
+    else:
+        default_list_name = project["name"]
+
     _tasks = []
     for task in [*tasks["tasks"], *tasks["completed_task_ids"]]:
         if type(task) == int:
@@ -834,20 +1436,12 @@ def prepare_task_data(
 
     prepared_tasks = []
     for task in _tasks:
-        found = filter(lambda x: x["task_id"] == task["id"], prepared_time_records)
+        found = records_by_task.get(task["id"], [])
 
-        pt = {**task, "list_names": [], "time_records": []}
-
-        for tr in found:
-            pt["list_names"].append(tr["list_name"])
-            pt["time_records"].append(tr)
-        else:
-            if len(prepared_time_records):
-                pt["list_names"].append(prepared_time_records[-1]["list_name"])
-            else:
-                pt["list_names"].append(project["name"])
-
-        pt["list_names"] = list(set(pt["list_names"]))
+        pt = {**task, "list_names": [], "time_records": list(found)}
+        pt["list_names"] = list(
+            set([tr["list_name"] for tr in found] + [default_list_name])
+        )
         
         prepared_tasks.append(pt)
 
@@ -858,16 +1452,23 @@ def prepare_task_data(
     if not len(list_names):
         list_names = set([pt["list_names"][0] for pt in prepared_tasks])
 
+    tasks_by_list_name = defaultdict(list)
+    for pt in prepared_tasks:
+        records_by_list_name = defaultdict(list)
+        for tr in pt["time_records"]:
+            records_by_list_name[tr["list_name"]].append(tr)
+
+        for ln in pt["list_names"]:
+            tasks_by_list_name[ln].append((pt, records_by_list_name[ln]))
+
     prepared_data = {}
 
     for ln in list_names:
         prepared_data[ln] = {}
         prepared_data[ln]["tasks"] = []
-        for t in filter(lambda x: ln in x["list_names"], prepared_tasks):
+        for t, list_time_records in tasks_by_list_name[ln]:
             task = {**t}
-            task["time_records"] = list(
-                filter(lambda x: x["list_name"] == ln, t["time_records"])
-            )
+            task["time_records"] = list_time_records
             task["rate"] = (
                 task["time_records"][0]["rate"] if len(task["time_records"]) else -1
             )
@@ -875,12 +1476,7 @@ def prepare_task_data(
 
         time_records_without_task = {
             "id": None,
-            "time_records": list(
-                filter(
-                    lambda x: x["task_id"] == None and x["list_name"] == ln,
-                    prepared_time_records,
-                )
-            ),
+            "time_records": records_without_task[ln],
         }
         time_records_without_task["rate"] = (
             time_records_without_task["time_records"][0]["rate"]
@@ -937,6 +1533,7 @@ def prepare_time_records(
                 if record["parent_type"] == "Task"
                 else None,
                 created_by_id=record["created_by_id"],
+                id=record["id"],
             )
         )
             
@@ -955,25 +1552,37 @@ def prepare_time_records(
             for tr in time_records
         ]
 
-        time_records_with_rate = filter(lambda x: x["rate"] > 0, time_records)
+        # Records without a rate go in the list of the nearest record in time
+        # that has one, found by bisecting the records sorted by timestamp
+        time_records_with_rate = sorted(
+            [(tr["ts"], i, tr) for i, tr in enumerate(time_records) if tr["rate"] > 0],
+            key=lambda x: x[:2],
+        )
+        timestamps = [ts for ts, _, _ in time_records_with_rate]
 
-        prepared_time_records = []
         for record in time_records:
-            try:
-                if record["name"] == 0 and len(list(time_records_with_rate)):
-                    closest = min(
-                        time_records_with_rate, key=lambda x: abs(x["ts"] - record["ts"])
-                    )
-                    record["name"] = closest["name"]
-                    record["list_name"] = closest["list_name"]
-
-                prepared_time_records.append(record)
-            except:
-                # At this point, we do nothing!
-                pass
-        return prepared_time_records
-    else:
-        return time_records
+            if record["name"] == 0 and timestamps:
+                closest = time_records_with_rate[
+                    find_closest(timestamps, record["ts"], time_records_with_rate)
+                ][2]
+                record["name"] = closest["name"]
+                record["list_name"] = closest["list_name"]
+
+    return time_records
+
+
+def find_closest(timestamps: list, ts: int, records: list) -> int:
+    # Index of the record closest to ts in the sorted timestamps. On ties the
+    # record that comes first in the (rate ordered) time records wins
+    i = bisect_left(timestamps, ts)
+
+    candidates = []
+    if i < len(timestamps):
+        candidates.append(i)
+    if i > 0:
+        candidates.append(bisect_left(timestamps, timestamps[i - 1]))
+
+    return min(candidates, key=lambda j: (abs(timestamps[j] - ts), records[j][1]))
 
 
 def import_ac_task(
@@ -983,11 +1592,21 @@ def import_ac_task(
     members: dict,
     job_types: dict,
     time_rate: int = -1,
+    store: Optional[MappingStore] = None,
 ) -> tuple:
-    task_comment_map = {}
+    prepared = prepare_ac_task(ac_task, members, job_types, time_rate)
+    if prepared is None:
+        return None, None
+
+    return write_ac_task(clickup, task_list_id, prepared, store)
 
+
+def prepare_ac_task(
+    ac_task: dict, members: dict, job_types: dict, time_rate: int = -1
+) -> Optional[dict]:
+    # Builds every ClickUp payload for the task without any network access
     if not is_task_importable(ac_task):
-        return None, None
+        return None
 
     single = ac_task["single"]
     name = single["name"]
@@ -1000,8 +1619,6 @@ def import_ac_task(
     tags = get_task_tags(name)
     status = get_task_status(ac_task)
 
-    rate_field_id = "83c64fc3-773b-4006-bc0d-ab26c930efbd"
-
     custom_fields = [
         # rate
         dict(id=rate_field_id, value=rate),
@@ -1034,57 +1651,105 @@ def import_ac_task(
     if member := members.get(single["created_by_id"]):
         token = member["token"]
 
-    task = clickup.get_or_create_task(task_list_id, name, json.dumps(data), token)
-    if "id" not in task:
-        print("Error: Retrying task...")
-        time.sleep(10)
-        task = clickup.get_or_create_task(task_list_id, name, json.dumps(data), token)
-        time.sleep(10)
-
-    if name.lower() == "check project status":
-        clickup.set_custom_field(task["id"], rate_field_id, rate)
-
-    data = dict()
-
-    if subscribers := ac_task["subscribers"]:
-        followers = []
-        for sub in subscribers:
-            if member := members.get(sub):
-                followers.append(member["user"]["id"])
-
-        if followers:
-            data["followers"] = dict(add=followers)
-
-    task = clickup.update_task(task["id"], data)
+    followers = []
+    for sub in ac_task["subscribers"]:
+        if member := members.get(sub):
+            followers.append(member["user"]["id"])
 
+    subtasks = []
     for subtask in ac_task["subtasks"]:
-        data = dict(
-            parent=task["id"],
+        subtask_data = dict(
             name=subtask["name"],
             status="Closed" if subtask["is_completed"] else status,
         )
 
         if member := get_assignee(members, subtask["assignee_id"], True):
-            data["assignees"] = [member["user"]["id"]]
+            subtask_data["assignees"] = [member["user"]["id"]]
 
-        token = None
+        subtask_token = None
         if member := members.get(subtask["created_by_id"]):
-            token = member["token"]
+            subtask_token = member["token"]
 
-        clickup.get_or_create_task(
-            task_list_id, subtask["name"], json.dumps(data), token
-        )
+        subtasks.append(dict(data=subtask_data, token=subtask_token))
 
+    comments = []
     for comment in ac_task["comments"]:
-        token = None
+        comment_token = None
         if member := members.get(comment["created_by_id"]):
-            token = member["token"]
+            comment_token = member["token"]
 
         text = comment["body_plain_text"]
         text = f"Originally posted by {comment['created_by_name']} on {get_date(comment['created_on'])} \n{text}"
 
+        comments.append(
+            dict(
+                id=comment["id"],
+                parent_id=comment["parent_id"],
+                text=text,
+                token=comment_token,
+            )
+        )
+
+    return dict(
+        name=name,
+        data=data,
+        token=token,
+        rate=rate,
+        followers=followers,
+        subtasks=subtasks,
+        comments=comments,
+    )
+
+
+def write_ac_task(
+    clickup: ClickUp,
+    task_list_id: int,
+    prepared: dict,
+    store: Optional[MappingStore] = None,
+) -> tuple:
+    task_comment_map = {}
+
+    name = prepared["name"]
+    data = json.dumps(prepared["data"])
+    token = prepared["token"]
+
+    # A new task gets its custom fields from the create payload, only tasks
+    # that already exist, such as those from the list template, need them set
+    existing = bool(clickup.find_task(task_list_id, name))
+
+    task = clickup.get_or_create_task(task_list_id, name, data, token)
+    if "id" not in task:
+        print("Error: Retrying task...")
+        time.sleep(10)
+        task = clickup.get_or_create_task(task_list_id, name, data, token)
+        time.sleep(10)
+
+    if existing and name.lower() == "check project status":
+        clickup.set_custom_field(task["id"], rate_field_id, prepared["rate"])
+
+    # Followers can't be set when creating a task
+    if followers := prepared["followers"]:
+        task = clickup.update_task(task["id"], dict(followers=dict(add=followers)))
+
+    for subtask in prepared["subtasks"]:
+        data = dict(parent=task["id"], **subtask["data"])
+
+        clickup.get_or_create_task(
+            task_list_id, data["name"], json.dumps(data), subtask["token"]
+        )
+
+    for comment in prepared["comments"]:
+        comment_key = f"{task['id']}:{comment['id']}"
+        if resume and store and store.get("task_comment", comment_key):
+            continue
+
         task_comment_map[comment["id"]] = comment["parent_id"]
-        clickup.get_or_create_comment(task["id"], text, token)
+        clickup_comment = clickup.get_or_create_comment(
+            task["id"], comment["text"], comment["token"]
+        )
+        if store:
+            store.set("comment", comment["id"], clickup_comment.get("id"))
+            store.set("task_comment", comment_key, clickup_comment.get("id"))
 
     return task, task_comment_map
 
@@ -1169,7 +1834,10 @@ def get_project_mappings(mapping_csv:str = 'data/ac_projects.csv') -> dict:
 
 
 def html_to_markdown(html: str) -> str:
-    return markdownify(html, escape_codeblocks=True, heading_style="ATX")
+    if markdown_cache:
+        return markdown_cache.convert(html)
+
+    return markdown.html_to_markdown(html)
 
 
 if __name__ == "__main__":
@@ -1179,6 +1847,20 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--fixexpenses", action='store_true', help = "Fix expenses", required = False)
     parser.add_argument("-n", "--noattachments", action='store_true', help = "Don't Import Attachments", required = False)
     parser.add_argument("-l", "--limit", help = "Limit projects to import (e.g. -l 2,3,4)", required = False, default = "")
+    parser.add_argument("-b", "--backup", help = "ActiveCollab backup to import from", required = False, default = default_snapshot_path)
+    parser.add_argument("-m", "--mappings", help = "AC to ClickUp id mapping store", required = False, default = default_store_path)
+    parser.add_argument("-w", "--workers", help = "Number of projects to import in parallel", required = False, type = int, default = 1)
+    parser.add_argument("-t", "--timeworkers", help = "Number of time entries to create in parallel per project", required = False, type = int, default = time_entry_workers)
+    parser.add_argument("-s", "--pipeline", help = "Number of writer threads sending prepared tasks to ClickUp while the next ones are read, per project", required = False, type = int, default = pipeline_writers)
+    parser.add_argument("-q", "--queuesize", help = "Prepared tasks waiting for the pipeline writers before reading blocks", required = False, type = int, default = pipeline_size)
+    parser.add_argument("-u", "--uploadworkers", help = "Number of attachments to upload in parallel", required = False, type = int, default = attachment_workers)
+    parser.add_argument("-r", "--ratelimit", help = "ClickUp requests per minute, shared by all workers", required = False, type = int, default = default_requests_per_minute)
+    parser.add_argument("-p", "--plan", help = "Only compile an import plan into this file, and estimate its API calls and duration", required = False, default = "")
+    parser.add_argument("-x", "--fromplan", help = "Import projects from a plan compiled with --plan", required = False, default = "")
+    parser.add_argument("-c", "--markdowncache", help = "Cache of task bodies converted to markdown", required = False, default = markdown.default_cache_path)
+    parser.add_argument("-k", "--markdownworkers", help = "Processes converting task bodies to markdown", required = False, type = int, default = os.cpu_count())
+    parser.add_argument("--resume", action='store_true', help = "Skip the steps a previous import recorded as completed", required = False)
+    parser.add_argument("-d", "--discover", action='store_true', help = "Rescan ClickUp for imported projects missing from the mapping store", required = False)
     argument = parser.parse_args()
 
     if argument.noattachments:
@@ -1197,58 +1879,92 @@ if __name__ == "__main__":
         import_attachments = False
         fix_expenses = True
 
+    time_entry_workers = argument.timeworkers
+    attachment_workers = argument.uploadworkers
+    pipeline_writers = argument.pipeline
+    pipeline_size = argument.queuesize
+
     if argument.limit:
         limit_projects = argument.limit.split(",")
         limit_projects_resume = limit_projects.copy()
 
         print("Importing these projects: {0}".format(limit_projects))
-    else:
-        limit_projects_resume = []
-        path = "data"
-        with open(os.path.join(path, "projects.json"), "r") as f:
-            ac_projects = json.load(f)
-            for project in ac_projects:
-                limit_projects_resume.append(project["id"])
-    
-        with open(os.path.join(path, "archived_projects.json"), "r") as f:
-            archived_projects = json.load(f)
-            for project in archived_projects:
-                limit_projects_resume.append(project["id"])
+
+    if argument.resume:
+        resume = True
+        print("Resuming from the import journal in {0}".format(argument.mappings))
+
+    # Generate mapping
+    project_mappings = get_project_mappings()
+
+    snapshot = Snapshot(argument.backup)
+
+    if argument.plan:
+        plan = compile_import_plan(snapshot, argument.ratelimit)
+        with open(argument.plan, "w") as f:
+            json.dump(plan, f)
+
+        print_import_plan(plan)
+        exit()
+
+    plan = None
+    if argument.fromplan:
+        with open(argument.fromplan, "r") as f:
+            plan = json.load(f)
 
     with open("clickup_secrets.json.nogit", "r") as f:
         secrets = json.load(f)
 
     clickup = ClickUp(
-        secrets["team_id"], secrets["api_token_v1"], secrets["api_tokens_v2"]["default"]
+        secrets["team_id"],
+        secrets["api_token_v1"],
+        secrets["api_tokens_v2"]["default"],
+        argument.ratelimit,
     )
 
-    # Generate mapping
-    project_mappings = get_project_mappings()
+    store = MappingStore(argument.mappings)
+    markdown_cache = markdown.MarkdownCache(
+        argument.markdowncache, argument.markdownworkers
+    )
+    # Before any import thread starts
+    markdown_cache.start()
 
-    # Get templates and re-order them into name: id dict
-    templates = clickup.get_templates()
+    try:
+        if argument.discover:
+            discover_imported_projects(clickup, store)
 
-    for x in templates:
-        templates_by_name[x["name"]] = x["id"]
-    
-
-    for key in project_mappings:
-        if not "Split" in project_mappings[key]["clickup_template"]:
-            project_mappings[key]["clickup_template_id"] = templates_by_name[project_mappings[key]["clickup_template"]]
+        # Get templates and re-order them into name: id dict
+        templates = clickup.get_templates()
 
+        for x in templates:
+            templates_by_name[x["name"]] = x["id"]
+    
 
-    members = get_members(clickup, tokens=secrets["api_tokens_v2"])
-    spaces = import_ac_labels(clickup)
-    if import_projects:
-        folders, lists, docs, pages, tasks, comment_map = import_ac_projects(
-            clickup, spaces, members
-        )
+        for key in project_mappings:
+            if not "Split" in project_mappings[key]["clickup_template"]:
+                project_mappings[key]["clickup_template_id"] = templates_by_name[project_mappings[key]["clickup_template"]]
+
+
+        members = get_members(clickup, snapshot, tokens=secrets["api_tokens_v2"])
+        spaces = import_ac_labels(clickup, snapshot)
+        if import_projects:
+            folders, lists, docs, pages, tasks, comment_map = import_ac_projects(
+                clickup,
+                spaces,
+                members,
+                store,
+                snapshot,
+                workers=argument.workers,
+                plan=plan,
+            )
     
-    if fix_expenses:
-        print("Fixing/reimporting expenses")
-        import_expenses(
-            clickup, members
-        )
+        if fix_expenses:
+            print("Fixing/reimporting expenses")
+            import_expenses(
+                clickup, members, store, snapshot
+            )
 
-    if import_attachments:
-        attachments = import_ac_attachments(clickup)
+        if import_attachments:
+            attachments = import_ac_attachments(clickup, store, snapshot)
+    finally:
+        markdown_cache.close()
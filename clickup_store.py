@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+from typing import Optional
+
+default_store_path = "clickup_mapping.db"
+
+
+class MappingStore:
+    """
+    Durable map of ActiveCollab ids to the ClickUp ids they were imported as.
+
+    Ids are grouped by kind (project, metadata_list, list, task, comment,
+    time_entry, ...) and stored as strings, so lookups by AC id are a single
+    indexed query regardless of how the id was typed in the AC data.
+
+    The store also keeps the import journal: the steps of each project that
+    have been completed, so an interrupted import can resume where it stopped.
+    And the hashes of synced source rows, so a sync can tell which changed.
+    """
+
+    def __init__(self, path: str = default_store_path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS mappings ("
+                "kind TEXT NOT NULL, "
+                "ac_id TEXT NOT NULL, "
+                "clickup_id TEXT NOT NULL, "
+                "PRIMARY KEY (kind, ac_id))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS journal ("
+                "project TEXT NOT NULL, "
+                "step TEXT NOT NULL, "
+                "completed_on TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "PRIMARY KEY (project, step))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "kind TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "hash TEXT NOT NULL, "
+                "PRIMARY KEY (kind, key))"
+            )
+
+    def get(self, kind: str, ac_id) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT clickup_id FROM mappings WHERE kind = ? AND ac_id = ?",
+                (kind, str(ac_id)),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, kind: str, ac_id, clickup_id) -> None:
+        if clickup_id is None:
+            return
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO mappings (kind, ac_id, clickup_id) "
+                "VALUES (?, ?, ?)",
+                (kind, str(ac_id), str(clickup_id)),
+            )
+
+    def all(self, kind: str) -> dict:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT ac_id, clickup_id FROM mappings WHERE kind = ?", (kind,)
+            ).fetchall()
+
+        return dict(rows)
+
+    def count(self, kind: str) -> int:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM mappings WHERE kind = ?", (kind,)
+            ).fetchone()[0]
+
+    def mark_done(self, project, step: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO journal (project, step) VALUES (?, ?)",
+                (str(project), step),
+            )
+
+    def done_steps(self, project) -> set:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT step FROM journal WHERE project = ?", (str(project),)
+            ).fetchall()
+
+        return {row[0] for row in rows}
+
+    def get_hash(self, kind: str, key) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM hashes WHERE kind = ? AND key = ?",
+                (kind, str(key)),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_hash(self, kind: str, key, hash: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes (kind, key, hash) VALUES (?, ?, ?)",
+                (kind, str(key), hash),
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
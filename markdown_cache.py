@@ -0,0 +1,108 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+
+from markdownify import markdownify
+
+default_cache_path = "markdown_cache.db"
+
+
+def html_to_markdown(html: str) -> str:
+    return markdownify(html, escape_codeblocks=True, heading_style="ATX")
+
+
+class MarkdownCache:
+    """
+    Markdown conversions of HTML bodies, kept on disk by a hash of the HTML so
+    retries and reruns never convert the same body twice.
+
+    Batches of bodies are converted in a process pool, off the GIL of the
+    threads doing the import. The pool should be started before any of those
+    threads, forking a process with threads running can deadlock the workers.
+    """
+
+    def __init__(
+        self, path: str = default_cache_path, workers: Optional[int] = None
+    ) -> None:
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS markdown ("
+                "hash TEXT PRIMARY KEY, "
+                "markdown TEXT NOT NULL)"
+            )
+
+    def start(self) -> None:
+        # Forks the worker processes now, the pool would otherwise fork them
+        # on its first batch, from whichever thread converts it
+        with self.lock:
+            if self.executor is not None or self.workers < 2:
+                return
+
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.executor.submit(int).result()
+
+    @staticmethod
+    def hash(html: str) -> str:
+        return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+    def get(self, html: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT markdown FROM markdown WHERE hash = ?", (self.hash(html),)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_many(self, conversions: Iterable[tuple]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO markdown (hash, markdown) VALUES (?, ?)",
+                ((self.hash(html), markdown) for html, markdown in conversions),
+            )
+
+    def convert(self, html: str) -> str:
+        if (markdown := self.get(html)) is not None:
+            return markdown
+
+        markdown = html_to_markdown(html)
+        self.set_many([(html, markdown)])
+
+        return markdown
+
+    def convert_all(self, bodies: Iterable[str]) -> int:
+        # Converts every body not in the cache yet and returns how many it did
+        missing = list({html for html in bodies if html and self.get(html) is None})
+
+        # Converted before set_many takes the lock, so other threads can
+        # still read the cache meanwhile
+        if len(missing) < 2 or self.workers < 2:
+            markdowns = [html_to_markdown(html) for html in missing]
+        else:
+            self.start()
+
+            chunksize = max(1, len(missing) // (self.workers * 4))
+            markdowns = list(
+                self.executor.map(html_to_markdown, missing, chunksize=chunksize)
+            )
+
+        self.set_many(zip(missing, markdowns))
+
+        return len(missing)
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown()
+
+        with self.lock:
+            self.connection.close()
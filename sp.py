@@ -1,15 +1,20 @@
 import argparse
 import csv
+import hashlib
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
+from typing import Any, Callable, Optional
 
 from tqdm import tqdm
-from urlextract import URLExtract
 
-from clickup import ClickUp
+from clickup import ClickUp, default_requests_per_minute, normalise_option
+from clickup_store import MappingStore, default_store_path
 
-extractor = URLExtract()
 logging.basicConfig(
     filemode="w",
     filename="sp.log",
@@ -18,23 +23,201 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+# Project size options are matched by the start of their name
+prefix_match_fields = [
+    "93a69e6d-c45a-4a2a-ba74-601772a671c8",
+    "ce5f3fed-6492-456e-8e63-ef329536abad",
+]
+
+# AC project ID to the _Metadata details task found for it in ClickUp
+found_tasks = {}
+
+# ClickUp field type to the function compiling a converter for a field of
+# that type, and field id to its compiled converter
+converter_factories = {}
+converters = {}
+
+
+class FieldUpdater:
+    """
+    Sends custom field updates to ClickUp and counts them.
+
+    With more than one worker the updates are sent by a fixed pool of threads,
+    all sharing the client's rate limiter, while the projects are still being
+    walked.
+    """
+
+    def __init__(self, clickup: ClickUp, workers: int = 1) -> None:
+        self.clickup = clickup
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.lock = threading.Lock()
+        self.futures = []
+        self.updates = 0
+        self.failed = 0
+        self.failed_tasks = set()
+        self.started = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def submit(self, task: str, field: str, value) -> None:
+        if not self.executor:
+            self.update(task, field, value)
+            return
+
+        with self.lock:
+            self.futures.append(self.executor.submit(self.update, task, field, value))
+
+    def update(self, task: str, field: str, value) -> None:
+        try:
+            response = self.clickup.set_custom_field(task, field, value)
+        except Exception as e:
+            response = dict(err=repr(e))
+
+        with self.lock:
+            if "err" in response:
+                self.failed += 1
+                self.failed_tasks.add(task)
+            else:
+                self.updates += 1
+
+    def close(self) -> None:
+        if self.executor:
+            for future in tqdm(
+                as_completed(self.futures), total=len(self.futures), desc="Updates"
+            ):
+                future.result()
+
+            self.executor.shutdown()
+
+        elapsed = time.monotonic() - self.started
+        summary = "{0} field updates, {1} failed, in {2:.0f}s: {3:.1f} updates/s".format(
+            self.updates, self.failed, elapsed, self.updates / elapsed if elapsed else 0
+        )
+        logger.info(summary)
+        print(summary)
+
 
-def update_project_data(clickup: ClickUp, project_ids: list, projects: dict):
+def update_project_data(
+    clickup: ClickUp,
+    project_ids: list,
+    projects: dict,
+    updater: FieldUpdater,
+    workers: int = 1,
+):
     if project_ids:
         for folder_id in tqdm(project_ids, desc="Projects"):
             folder = clickup.get_folder(folder_id)
-            update_project(clickup, folder, projects)
+            update_project(clickup, folder, projects, updater)
+    elif workers > 1:
+        # Spaces are walked in parallel, their field updates go to the updater
+        spaces = clickup.get_spaces()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    update_space, clickup, space, projects, updater, False
+                ): space
+                for space in spaces
+            }
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Spaces"):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"Space {futures[future]['name']} failed")
     else:
         spaces = clickup.get_spaces()
         for space in tqdm(spaces, desc="Spaces"):
-            logger.info(f"Space {space['name']}")
+            update_space(clickup, space, projects, updater)
+
+
+def get_row_hash(row: dict) -> str:
+    return hashlib.sha256(json.dumps(row, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def update_changed_projects(
+    clickup: ClickUp,
+    store: MappingStore,
+    projects: dict,
+    updater: FieldUpdater,
+    workers: int = 1,
+    full: bool = False,
+) -> dict:
+    # Updates the projects whose SharePoint row is new or changed since the
+    # last sync, and returns the AC project ID to row hash of those it tried
+    hashes = {ac_id: get_row_hash(row) for ac_id, row in projects.items()}
+
+    tasks = {}
+    unmapped = set()
+    for ac_id, row_hash in hashes.items():
+        if not full and store.get_hash("sp_row", ac_id) == row_hash:
+            continue
+
+        if task_id := store.get("sp_task", ac_id) or store.get("details_task", ac_id):
+            tasks[ac_id] = task_id
+        # Rows that weren't in ClickUp last time and haven't changed don't
+        # need every project walked again
+        elif full or store.get_hash("sp_row_unmatched", ac_id) != row_hash:
+            unmapped.add(ac_id)
+
+    summary = f"{len(tasks) + len(unmapped)} of {len(projects)} SharePoint rows to sync"
+    logger.info(summary)
+    print(summary)
+
+    # Rows that are None in the dict passed on are left alone by update_task
+    pending = {ac_id: projects[ac_id] if ac_id in tasks else None for ac_id in projects}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        fetched = executor.map(clickup.get_task, tasks.values())
+
+        for task in tqdm(fetched, total=len(tasks), desc="Projects"):
+            if "custom_fields" in task:
+                update_task(clickup, task.get("folder", {}), task, pending, updater)
+
+    # Mapped tasks that have gone or moved to another project are looked for
+    unmapped.update(ac_id for ac_id in tasks if found_tasks.get(ac_id) != tasks[ac_id])
+
+    if unmapped:
+        pending = {
+            ac_id: projects[ac_id] if ac_id in unmapped else None for ac_id in projects
+        }
+        update_project_data(clickup, None, pending, updater, workers)
+
+    return {ac_id: hashes[ac_id] for ac_id in tasks.keys() | unmapped}
 
-            folders = clickup.get_folders(space["id"], archived=True)
-            for folder in tqdm(folders, desc="Projects", leave=False):
-                update_project(clickup, folder, projects)
 
+def save_sync(store: MappingStore, hashes: dict, updater: FieldUpdater) -> None:
+    # Once the updates are sent, the hashes of the rows synced without errors
+    # are kept, so the next run skips them until they change
+    for ac_id, task_id in found_tasks.items():
+        store.set("sp_task", ac_id, task_id)
 
-def update_project(clickup: ClickUp, folder: dict, projects: dict):
+    for ac_id, row_hash in hashes.items():
+        if ac_id not in found_tasks:
+            store.set_hash("sp_row_unmatched", ac_id, row_hash)
+        elif found_tasks[ac_id] not in updater.failed_tasks:
+            store.set_hash("sp_row", ac_id, row_hash)
+
+
+def update_space(
+    clickup: ClickUp,
+    space: dict,
+    projects: dict,
+    updater: FieldUpdater,
+    progress: bool = True,
+):
+    logger.info(f"Space {space['name']}")
+
+    folders = clickup.get_folders(space["id"], archived=True)
+    for folder in tqdm(folders, desc="Projects", leave=False, disable=not progress):
+        update_project(clickup, folder, projects, updater)
+
+
+def update_project(
+    clickup: ClickUp, folder: dict, projects: dict, updater: FieldUpdater
+):
     logger.info(f"Project {folder['name']}")
 
     for l in folder["lists"]:
@@ -42,27 +225,30 @@ def update_project(clickup: ClickUp, folder: dict, projects: dict):
             metadata = clickup.get_list(l["id"])
             for task in clickup.get_tasks(metadata["id"]):
                 if folder["name"].startswith(task["name"]):
-                    update_task(clickup, folder, task, projects)
+                    update_task(clickup, folder, task, projects, updater)
 
 
 def update_task(
-    clickup: ClickUp, folder: dict, task: dict, projects: dict
+    clickup: ClickUp, folder: dict, task: dict, projects: dict, updater: FieldUpdater
 ):
-    ac_project_id_field = filter(
-        lambda x: x["name"] == "AC project ID", task["custom_fields"]
-    )
-    if not ac_project_id_field:
-        logger.warning(f"AC project ID not found for project {folder['name']}")
+    fields = {}
+    for field in task["custom_fields"]:
+        fields.setdefault(field["name"], field)
+
+    if not (ac_project_id_field := fields.get("AC project ID")):
+        logger.warning(f"AC project ID not found for project {folder.get('name')}")
         return
 
-    ac_project_id = list(ac_project_id_field)[0].get("value")
+    ac_project_id = ac_project_id_field.get("value")
     if ac_project_id not in projects:
         logger.warning(
-            f"Project {ac_project_id}: {folder['name']} not found in Sharepoint"
+            f"Project {ac_project_id}: {folder.get('name')} not found in Sharepoint"
         )
         return
 
-    data = projects[ac_project_id]
+    found_tasks[ac_project_id] = task["id"]
+    if not (data := projects[ac_project_id]):
+        return
 
     for field in task["custom_fields"]:
         field_name = field["name"].strip()
@@ -70,75 +256,114 @@ def update_task(
         if field_name in data:
             value = data[field_name]
             if value and not field_value:
-                update_field(clickup, task, field, value)
-
+                update_field(clickup, updater, task, field, value)
 
-def update_field(clickup: ClickUp, task: dict, field: dict, data: str):
-    field_type = field["type"]
 
+def update_field(
+    clickup: ClickUp, updater: FieldUpdater, task: dict, field: dict, data: str
+):
     data = data.strip()
-    value = data
-
-    if field_type == "currency":
-        value = float(data.replace("£", "").replace(",", ""))
-    elif field_type == "date":
-        value = datetime.strptime(data, "%d/%m/%Y").timestamp() * 1000
-    elif field_type in ["drop_down", "labels"]:
-        field_value = "name"
-        if field_type == "labels":
-            field_value = "label"
-
-        if found := find_value(field, field_value, data):
-            value = found[0].get("id")
-        else:
-            logger.error(f"Value {data} not found for field {field['name']}")
-            return
 
-        if field_type == "labels":
-            value = [value]
-    elif field_type == "url":
-        value = value.replace("&%2358;", ":")
-        value = list(set(extractor.find_urls(value)))
-        value = value[0] if value else ""
+    if (value := get_converter(clickup, field)(data)) is None:
+        logger.error(f"Value {data} not found for field {field['name']}")
+        return
+
+    updater.submit(task["id"], field["id"], value)
 
-    clickup.set_custom_field(task["id"], field["id"], value)
 
+def get_converter(clickup: ClickUp, field: dict) -> Callable[[str], Any]:
+    # The function turning a SharePoint value into the value ClickUp expects
+    # for the field, compiled the first time the field is seen
+    if not (convert := converters.get(field["id"])):
+        factory = converter_factories.get(field["type"], lambda clickup, field: str)
+        convert = converters.setdefault(field["id"], factory(clickup, field))
 
-def find_value(field: dict, field_value: str, data: str):
-    data = data.lower()
+    return convert
 
-    # Project size
-    if field["id"] in [
-        "93a69e6d-c45a-4a2a-ba74-601772a671c8",
-        "ce5f3fed-6492-456e-8e63-ef329536abad",
-    ]:
-        return list(
-            filter(
-                lambda x: x[field_value].strip().lower().startswith(data),
-                field["type_config"]["options"],
-            )
-        )
 
-    return list(
-        filter(
-            lambda x: x[field_value].strip().lower() == data,
-            field["type_config"]["options"],
-        )
-    )
+def converter(*field_types: str):
+    def register(factory):
+        for field_type in field_types:
+            converter_factories[field_type] = factory
+
+        return factory
+
+    return register
+
+
+@converter("currency")
+def currency_converter(clickup: ClickUp, field: dict) -> Callable[[str], float]:
+    return lambda data: float(data.replace("£", "").replace(",", ""))
+
+
+@converter("date")
+def date_converter(clickup: ClickUp, field: dict) -> Callable[[str], float]:
+    return parse_date
+
+
+@converter("drop_down", "labels")
+def option_converter(clickup: ClickUp, field: dict) -> Callable[[str], Any]:
+    options = {
+        name: ids[0]
+        for name, ids in clickup.get_field_options(
+            field, field["id"] in prefix_match_fields
+        ).items()
+    }
+    is_labels = field["type"] == "labels"
+
+    def convert(data: str) -> Optional[Any]:
+        if (value := options.get(normalise_option(data))) is None:
+            return None
+
+        return [value] if is_labels else value
+
+    return convert
+
+
+@converter("url")
+def url_converter(clickup: ClickUp, field: dict) -> Callable[[str], str]:
+    return find_url
+
+
+@lru_cache(maxsize=None)
+def parse_date(data: str) -> float:
+    return datetime.strptime(data, "%d/%m/%Y").timestamp() * 1000
+
+
+@lru_cache(maxsize=None)
+def find_url(data: str) -> str:
+    urls = list(set(get_extractor().find_urls(data.replace("&%2358;", ":"))))
+
+    return urls[0] if urls else ""
+
+
+@lru_cache
+def get_extractor():
+    # Loading the TLD list is slow, so it's only done once a URL is needed
+    from urlextract import URLExtract
+
+    return URLExtract()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--projects", help="ClickUp folder ids (projects) to import, comma separated")
+    parser.add_argument("-w", "--workers", help="Spaces walked and field updates sent in parallel", type=int, default=1)
+    parser.add_argument("-m", "--mappings", help="SQLite store of the ClickUp ids and synced rows", default=default_store_path)
+    parser.add_argument("-f", "--full", help="Update every project, not only those whose row changed", action="store_true")
+    parser.add_argument("-r", "--ratelimit", help="ClickUp requests per minute, shared by all workers", type=int, default=default_requests_per_minute)
+    arguments = parser.parse_args()
+
     with open("clickup_secrets.json.nogit", "r") as f:
         secrets = json.load(f)
 
     clickup = ClickUp(
-        secrets["team_id"], secrets["api_token_v1"], secrets["api_tokens_v2"]["default"]
+        secrets["team_id"],
+        secrets["api_token_v1"],
+        secrets["api_tokens_v2"]["default"],
+        arguments.ratelimit,
     )
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--projects", help="ClickUp folder ids (projects) to import, comma separated")
-    arguments = parser.parse_args()
-
     project_ids = None
     if arguments.projects:
         project_ids = arguments.projects.split(",")
@@ -150,4 +375,18 @@ if __name__ == "__main__":
             for row in spreader
         }
 
-    update_project_data(clickup, project_ids, projects)
\ No newline at end of file
+    store = MappingStore(arguments.mappings)
+    hashes = {}
+
+    with FieldUpdater(clickup, arguments.workers) as updater:
+        if project_ids:
+            update_project_data(
+                clickup, project_ids, projects, updater, arguments.workers
+            )
+        else:
+            hashes = update_changed_projects(
+                clickup, store, projects, updater, arguments.workers, arguments.full
+            )
+
+    save_sync(store, hashes, updater)
+    store.close()
\ No newline at end of file